@@ -1,5 +1,6 @@
 # A time delay class for the micropython board. Based on the scheduler class. 24th Aug 2014
 # Author: Peter Hinch
+# V1.5 Delay and future() share a single timer service thread per scheduler.
 # V1.4 17 May 2016
 # Used by Pushbutton library.
 # This class implements the software equivalent of a retriggerable monostable. When first instantiated
@@ -11,7 +12,12 @@
 # The usual caveats re microsheduler time periods applies: if you need millisecond accuracy
 # (or better) use a hardware timer. Times can easily be -0 +20mS or more, depending on other threads
 
-from usched import Sched, microsWhen, seconds, after, microsUntil, Timeout, wait
+from usched import Waitfor, Event, TimerException, microsWhen, seconds, after, TIMERPERIOD, MAXTIME, MAXSECS
+from utime import ticks_us
+try:
+    from heapq import heappush, heappop, heapify
+except ImportError:
+    from uheapq import heappush, heappop, heapify
 
 def _f(): pass
 FunctionType = type(_f) # Function or lambda
@@ -23,43 +29,139 @@ class _C:
     def _m(self): pass
 MethodType = type(_C()._m)
 
-class Delay(object):
-    def __init__(self, objSched, callback=None, callback_args=()):
+# TIMER SERVICE
+# All Timer instances belonging to a scheduler share one thread. Pending timers are held in a heap
+# ordered by deadline so scheduling a callback costs a heap insert rather than a new thread. Heap
+# entries are [key, seq, deadline, timer]: key is the deadline relative to self.ref which keeps
+# ordering valid across timer rollover. seq breaks ties so timers are never compared.
+# An entry is live only while it is its timer's _entry: cancelling or restarting a timer simply
+# orphans the old entry which is discarded when it reaches the top of the heap.
+# The thread is started by the first insertion and runs for the life of the scheduler: while no timers are pending
+# it waits on an Event so is not polled. A parked thread does not prevent the scheduler from terminating.
+
+class TimerService(Waitfor):
+    def __init__(self, objSched):
+        super().__init__()
         self.objSched = objSched
+        self.heap = []
+        self.seq = 0
+        self.ref = ticks_us()                   # Reference time for heap keys
+        self.active = False                     # True while the service thread exists
+        self.wake = Event()                     # Set when a timer is inserted
+
+    def triggered(self):                        # Polled by scheduler: due when earliest deadline has passed
+        heap = self.heap
+        if heap:
+            res = after(heap[0][2])
+            if res:
+                return (0, 0, res)
+        return None
+
+    def _rebase(self):                          # Keep reference within MAXTIME//2 of now
+        if not self.heap:
+            self.ref = ticks_us()
+        elif after(self.ref) > MAXTIME // 2:
+            ref = ticks_us()
+            for entry in self.heap:
+                key = (entry[2] - ref) & TIMERPERIOD
+                entry[0] = 0 if key >= MAXTIME else key # Already overdue
+            heapify(self.heap)
+            self.ref = ref
+
+    def insert(self, timer, tstop):
+        self._rebase()
+        self.seq = (self.seq + 1) & TIMERPERIOD
+        entry = [(tstop - self.ref) & TIMERPERIOD, self.seq, tstop, timer]
+        timer._entry = entry
+        heappush(self.heap, entry)
+        self.wake.set()
+        if not self.active:
+            self.active = True
+            self.objSched.add_thread(self._run())
+
+    def _run(self):                             # Runs until the scheduler closes it
+        heap = self.heap
+        try:
+            while True:
+                if heap:
+                    yield self
+                else:
+                    self.wake.clear()
+                    yield self.wake             # Idle: parked until a timer is inserted
+                while heap and after(heap[0][2]):
+                    entry = heappop(heap)
+                    timer = entry[3]
+                    if timer._entry is entry:   # Discard cancelled or restarted entries
+                        timer._entry = None
+                        timer._expire()
+                self._rebase()
+        finally:                                # Also runs if the scheduler closes the thread
+            self.active = False
+
+def _service(objSched):
+    try:
+        return objSched.timerservice
+    except AttributeError:
+        objSched.timerservice = TimerService(objSched)
+        return objSched.timerservice
+
+# TIMER CLASS
+# A cancellable handle for a callback to be run after a time delay.
+
+class Timer(object):
+    def __init__(self, objSched, callback=None, callback_args=()):
+        self.service = _service(objSched)
         self.callback = callback
         self.callback_args = callback_args
-        self._running = False
+        self._entry = None
+        self._hops = 0                          # No. of MAXSECS periods remaining for long delays
+
+    def start(self, secs):                      # (Re)start: any pending callback is cancelled
+        if secs <= 0:
+            raise TimerException()
+        hops, first = divmod(secs, MAXSECS)
+        if first <= 0:                          # Exact multiple of MAXSECS
+            hops -= 1
+            first = MAXSECS
+        self._hops = int(hops)
+        self.service.insert(self, microsWhen(seconds(first)))
+
+    def cancel(self):
+        self._entry = None
+
+    def pending(self):
+        return self._entry is not None
+
+    def _expire(self):
+        if self._hops:
+            self._hops -= 1
+            self.service.insert(self, microsWhen(seconds(MAXSECS)))
+        elif self.callback is not None:
+            self.callback(*self.callback_args)
+
+class Delay(object):
+    def __init__(self, objSched, callback=None, callback_args=()):
+        self.timer = Timer(objSched, callback, callback_args)
 
     def stop(self):
-        self._running = False
+        self.timer.cancel()
 
     def trigger(self, duration):
-        self.tstop = microsWhen(seconds(duration))          # Update end time
-        if not self._running:                               # Start a thread which stops the
-            self.objSched.add_thread(self.killer())         # delay after its period has elapsed
-            self._running = True
+        self.timer.start(duration)                          # Update end time
 
     def running(self):
-        return self._running
+        return self.timer.pending()
 
-    def killer(self):
-        to = Timeout(1)                                     # Initial value is arbitrary
-        while not after(self.tstop):                        # Might have been retriggered
-            yield to._ussetdelay(microsUntil(self.tstop))
-        if self._running and self.callback is not None:
-            self.callback(*self.callback_args)
-        self._running = False
+def _spawn(objSched, thread, thread_args):
+    objSched.add_thread(thread(*thread_args))
 
-def _future(objSched, time_to_run, callback, callback_args):
-    yield                                       # No initialisation to do
-    yield from wait(time_to_run)
+def future(objSched, time_to_run, callback, callback_args=()):
     t = type(callback)
     if t is FunctionType or t is MethodType:
-        callback(*callback_args)
+        timer = Timer(objSched, callback, callback_args)
     elif t is ThreadType:                       # Generator function (thread)
-        objSched.add_thread(callback(*callback_args))
+        timer = Timer(objSched, _spawn, (objSched, callback, callback_args))
     else:
         raise ValueError('future() received an invalid callback')
-
-def future(objSched, time_to_run, callback, callback_args=()):
-    objSched.add_thread(_future(objSched, time_to_run, callback, callback_args))
+    timer.start(time_to_run)
+    return timer
@@ -0,0 +1,70 @@
+# eventqueue.py Deferred execution of callbacks from device drivers
+# Author: Peter Hinch
+# Copyright Peter Hinch 2016 Released under the MIT license
+
+from usched import Poller
+
+# ************************************************ EVENTQUEUE CLASS *************************************************
+
+# Device drivers such as Switch and Pushbutton normally run user callbacks in the thread which samples the
+# hardware: a slow callback delays sampling of that device and every other thread. If a driver is passed an
+# EventQueue the callback and its arguments are queued instead and run later by a dispatcher thread, or by a user
+# thread which yields the queue's await_obj and calls run().
+# The queue is preallocated with a fixed number of slots. If it is full, new events are discarded and counted. If
+# coalescing is enabled an event identical to the most recently queued one is discarded while the latter is pending.
+
+class EventQueue(object):
+    def __init__(self, size=16, coalesce=False):
+        if size < 1:
+            raise ValueError('Queue size must be >= 1')
+        self.size = size
+        self.funcs = [None]*size
+        self.args = [None]*size
+        self.wi = 0                                         # Write index
+        self.ri = 0                                         # Read index
+        self.count = 0                                      # No. of events pending
+        self.coalesce = coalesce
+        self.dropped = 0                                    # No. of events lost to overflow
+        self.coalesced = 0                                  # No. of duplicate events discarded
+        self.await_obj = Poller(self._pollfunc)
+
+    def __len__(self):
+        return self.count
+
+    def _pollfunc(self):
+        return 1 if self.count else None
+
+    def put(self, func, args=()):                           # Returns True if queued
+        if self.coalesce and self.count:
+            last = (self.wi - 1) % self.size
+            if self.funcs[last] is func and self.args[last] == args:
+                self.coalesced += 1
+                return False
+        if self.count >= self.size:
+            self.dropped += 1
+            return False
+        self.funcs[self.wi] = func
+        self.args[self.wi] = args
+        self.wi = (self.wi + 1) % self.size
+        self.count += 1
+        return True
+
+    def run(self, maxevents=0):                             # Run pending events (all if maxevents == 0)
+        ran = 0
+        while self.count and (maxevents == 0 or ran < maxevents):
+            func = self.funcs[self.ri]
+            args = self.args[self.ri]
+            self.funcs[self.ri] = None                      # Don't retain references
+            self.args[self.ri] = None
+            self.ri = (self.ri + 1) % self.size
+            self.count -= 1
+            func(*args)
+            ran += 1
+        return ran
+
+    def dispatcher(self, batch=4):                          # Generator object: thread which runs events
+        yield
+        while True:
+            yield self.await_obj
+            self.run(batch)
+            yield                                           # Let roundrobin threads run between batches
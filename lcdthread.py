@@ -16,7 +16,8 @@
 # Date   : 26/07/2012
 
 import pyb
-from usched import Timeout, Roundrobin
+from utime import ticks_us
+from usched import Timeout, Roundrobin, after
 
 # **************************************************** LCD DRIVER ***************************************************
 
@@ -29,11 +30,12 @@ D7   14   3        Y3
 D6   13   4        Y4
 D5   12   5        Y5
 D4   11   6        Y6
+RW    5   optional (connect to ground if not used)
 """
 
 # *********************************** GLOBAL CONSTANTS: MICROPYTHON PIN NUMBERS *************************************
 
-# Supply as board pin numbers as a tuple Rs, E, D4, D5, D6, D7
+# Supply as board pin numbers as a tuple Rs, E, D4, D5, D6, D7 with optional RW
 
 PINLIST = ('Y1','Y2','Y6','Y5','Y4','Y3')
 
@@ -53,10 +55,15 @@ PINLIST = ('Y1','Y2','Y6','Y5','Y4','Y3')
 # No point in having a message queue: people's eyes aren't that quick. Just display the most recent data for each line.
 # Assigning changed data to the LCD object sets a "dirty" flag for that line. The LCD's runlcd thread then updates the
 # hardware and clears the flag
+# The LCD object keeps a shadow copy of the text on the display. Only runs of changed characters are sent, each
+# preceded by a command setting the cursor position. Runs separated by a single unchanged character are merged as
+# this costs no more bus time than a cursor command.
 
-# Note that the lcd_nybble method uses explicit delays rather than yields. This is for two reasons.
-# The delays are short in the context of general runtimes and minimum likely yield delays, so won't
-# significantly impact performance. Secondly, using yield produced perceptibly slow updates to the display text.
+# Once initialised the driver does not use fixed delays. The enable pulse width and data setup times are met by
+# interpreter overhead. The controller needs time to execute each byte: if the RW pin is supplied its busy flag is
+# polled before a byte is sent, otherwise the driver only waits for whatever part of the execution time has not
+# already elapsed since the previous byte. In practice this is rarely nonzero. The runlcd thread sends a batch of
+# characters between yields and records the time for which it blocks the scheduler.
 
 class LCD(object):                                          # LCD objects appear as read/write lists
     INITSTRING = (0x33, 0x32, 0x28, 0x0C, 0x06, 0x01)
@@ -64,38 +71,81 @@ class LCD(object):                                          # LCD objects appear
     CHR = True
     CMD = False
     E_PULSE = 50                                            # Timing constants in uS
-    E_DELAY = 50
-    def __init__(self, pinlist, scheduler, cols, rows = 2): # Init with pin nos for enable, rs, D4, D5, D6, D7
+    E_DELAY = 50                                            # Execution time of most instructions
+    CLR_DELAY = 2000                                        # Clear and home instructions
+    BUSY_POLLS = 100                                        # Give up if busy flag doesn't clear
+    BATCH = 8                                               # No. of characters written between yields
+    def __init__(self, pinlist, scheduler, cols, rows = 2): # Init with pin nos for enable, rs, D4, D5, D6, D7, rw
         self.initialising = True
         self.LCD_E = pyb.Pin(pinlist[1], pyb.Pin.OUT_PP)    # Create and initialise the hardware pins
         self.LCD_RS = pyb.Pin(pinlist[0], pyb.Pin.OUT_PP)
-        self.datapins = [pyb.Pin(pin_name, pyb.Pin.OUT_PP) for pin_name in pinlist[2:]]
+        self.datapins = [pyb.Pin(pin_name, pyb.Pin.OUT_PP) for pin_name in pinlist[2:6]]
+        self.LCD_RW = None
+        if len(pinlist) > 6:                                # Busy flag can be read
+            self.LCD_RW = pyb.Pin(pinlist[6], pyb.Pin.OUT_PP)
+            self.LCD_RW.value(False)
+        self.tlast = ticks_us()                             # Time last byte was sent
+        self.twait = 0                                      # and its execution time
+        self.refresh_us = 0                                 # Blocking time of last row update
+        self.max_block_us = 0                               # Longest time between yields
         self.cols = cols
         self.rows = rows
         self.lines = [""]*self.rows
         self.dirty = [False]*self.rows
+        self.shadow = [" "*self.cols]*self.rows              # Text on the display: blank after initialisation
         for thisbyte in LCD.INITSTRING:
             self.lcd_byte(thisbyte, LCD.CMD)
-            self.initialising = False                       # Long delay after first byte only
+        self.initialising = False                           # Long delay after each initialisation pulse only
         scheduler.add_thread(runlcd(self))
 
     def lcd_nybble(self, bits):                             # send the LS 4 bits
         for pin in self.datapins:
             pin.value(bits & 0x01)
             bits >>= 1
-        pyb.udelay(LCD.E_DELAY)    
-        self.LCD_E.value(True)                              # Toggle the enable pin
-        pyb.udelay(LCD.E_PULSE)
-        self.LCD_E.value(False)
         if self.initialising:
+            pyb.udelay(LCD.E_DELAY)
+            self.LCD_E.value(True)                          # Toggle the enable pin
+            pyb.udelay(LCD.E_PULSE)
+            self.LCD_E.value(False)
             pyb.delay(5)
         else:
-            pyb.udelay(LCD.E_DELAY)      
+            self.LCD_E.value(True)                          # Pulse width exceeds 450ns owing to interpreter overhead
+            self.LCD_E.value(False)
+
+    def busy(self):                                         # Read the busy flag: requires the RW pin
+        self.LCD_RS.value(False)
+        for pin in self.datapins:
+            pin.init(pyb.Pin.IN)
+        self.LCD_RW.value(True)
+        for _ in range(LCD.BUSY_POLLS):
+            self.LCD_E.value(True)
+            busy = self.datapins[3].value()                 # D7 is the busy flag
+            self.LCD_E.value(False)
+            self.LCD_E.value(True)                          # Clock out the low nybble of the address counter
+            self.LCD_E.value(False)
+            if not busy:
+                break
+        self.LCD_RW.value(False)
+        for pin in self.datapins:
+            pin.init(pyb.Pin.OUT_PP)
+        return busy
+
+    def ready(self):                                        # Wait until the controller can accept a byte
+        if self.initialising:
+            return
+        if self.LCD_RW is not None:
+            self.busy()
+        else:                                               # Usually already elapsed
+            while after(self.tlast) < self.twait:
+                pass
 
     def lcd_byte(self, bits, mode):                         # Send byte to data pins: bits = data
+        self.ready()
         self.LCD_RS.value(mode)                             # mode = True  for character, False for command
         self.lcd_nybble(bits >>4)                           # send high bits
         self.lcd_nybble(bits)                               # then low ones
+        self.tlast = ticks_us()
+        self.twait = LCD.CLR_DELAY if mode == LCD.CMD and bits < 4 else LCD.E_DELAY
 
     def __setitem__(self, line, message):                   # Send string to display line 0 or 1
                                                             # Strip or pad to width of display. Should use "{0:{1}.{1}}".format("rats", 20)
@@ -110,15 +160,38 @@ class LCD(object):                                          # LCD objects appear
 def runlcd(thislcd):                                        # Periodically check for changed text and update LCD if so
     wf = Timeout(0.02)
     rr = Roundrobin()
+    cols = thislcd.cols
     while(True):
         for row in range(thislcd.rows):
             if thislcd.dirty[row]:
+                thislcd.dirty[row] = False                  # Clear now: line may be changed while we yield
                 msg = thislcd[row]
-                thislcd.lcd_byte(LCD.LCD_LINES[row], LCD.CMD)
-                for thisbyte in msg:
-                    thislcd.lcd_byte(ord(thisbyte), LCD.CHR)
-                    yield rr                                # Reshedule ASAP
-                thislcd.dirty[row] = False
+                shadow = thislcd.shadow[row]
+                refresh = 0
+                tstart = ticks_us()
+                batch = LCD.BATCH
+                start = 0
+                while start < cols:
+                    if msg[start] == shadow[start]:
+                        start += 1
+                        continue
+                    end = start + 1                         # Find end of run of changed characters
+                    while end < cols and (msg[end] != shadow[end] or (end + 1 < cols and msg[end + 1] != shadow[end + 1])):
+                        end += 1
+                    thislcd.lcd_byte(LCD.LCD_LINES[row] + start, LCD.CMD) # Set cursor position
+                    for thisbyte in msg[start:end]:
+                        thislcd.lcd_byte(ord(thisbyte), LCD.CHR)
+                        batch -= 1
+                        if batch <= 0:
+                            batch = LCD.BATCH
+                            block = after(tstart)
+                            refresh += block
+                            thislcd.max_block_us = max(thislcd.max_block_us, block)
+                            yield rr                        # Reshedule ASAP
+                            tstart = ticks_us()
+                    start = end
+                thislcd.shadow[row] = msg
+                block = after(tstart)
+                thislcd.refresh_us = refresh + block
+                thislcd.max_block_us = max(thislcd.max_block_us, block)
         yield wf()                                          # Give other threads a look-in
-
-
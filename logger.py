@@ -0,0 +1,115 @@
+# logger.py Buffered output for the scheduler
+# Author: Peter Hinch
+# Copyright Peter Hinch 2016 Released under the MIT license
+
+from usched import Event, Timeout
+
+# ************************************************* LOGGER CLASS ****************************************************
+
+# print() blocks until the USB or UART has accepted the text, which can take milliseconds: a thread which prints
+# delays every other thread. A Logger's print() and write() methods copy the text into a preallocated ring buffer
+# and return immediately. A thread writes the buffer to the output in chunks of at most chunk bytes, yielding
+# between chunks with round robin (lowest) priority; while the buffer is empty it waits on an Event so costs nothing.
+# A message which does not fit in the free space is discarded and counted. Not for use in interrupt handlers.
+# print() copies each argument and separator into the buffer in turn, so the only allocation is str() of
+# arguments which are not already strings. A str is copied without encoding where the port allows (MicroPython)
+# and if it neither wraps the end of the buffer nor contains multi-byte characters.
+
+class Logger(object):
+    def __init__(self, objSched, size=512, stream=None, chunk=32):
+        if size < 1 or chunk < 1:
+            raise ValueError('size and chunk must be >= 1')
+        if stream is None:
+            import sys
+            stream = getattr(sys.stdout, 'buffer', sys.stdout)   # CPython needs the binary stream
+        self.stream = stream
+        self.stream_flush = getattr(stream, 'flush', None)
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.size = size
+        self.chunk = chunk
+        self.wi = 0                                         # Write index
+        self.ri = 0                                         # Read index
+        self.count = 0                                      # No. of bytes held
+        self.pwi = 0                                        # Write index and count of message being added
+        self.pcount = 0
+        self.dropped = 0                                    # No. of messages discarded
+        self.await_obj = Event()                            # Set when there is data to output
+        self.backoff = Timeout(0.01)                        # Stream accepted nothing: retry later
+        objSched.add_thread(self._drain())                  # Thread runs forever
+
+    def __len__(self):
+        return self.count
+
+    def write(self, s):                                     # Queue a str or bytes. Returns False if discarded
+        self.pwi = self.wi
+        self.pcount = self.count
+        return self._put(s) and self._commit()
+
+    def print(self, *args, sep=' ', end='\n'):
+        self.pwi = self.wi
+        self.pcount = self.count
+        first = True
+        for arg in args:
+            if not (first or self._put(sep)):
+                return False
+            first = False
+            if not self._put(arg if isinstance(arg, str) else str(arg)):
+                return False
+        return self._put(end) and self._commit()
+
+    def _put(self, s):                                      # Append to the message being added. False if discarded
+        n = len(s)
+        if n > self.size - self.pcount:
+            self.dropped += 1
+            return False
+        wi = self.pwi
+        first = self.size - wi                              # Bytes before the end of the buffer
+        try:
+            if n <= first:
+                self.mv[wi:wi + n] = s
+            else:
+                src = memoryview(s)
+                self.mv[wi:] = src[:first]
+                self.mv[0:n - first] = src[first:]
+        except (TypeError, ValueError):                     # A str on CPython, or with multi-byte characters
+            if not isinstance(s, str):
+                raise
+            return self._put(s.encode())
+        self.pwi = (wi + n) % self.size
+        self.pcount += n
+        return True
+
+    def _commit(self):                                      # Message fitted: make it visible to the thread
+        self.wi = self.pwi
+        self.count = self.pcount
+        self.await_obj.set()
+        return True
+
+    def flush(self):                                        # Output everything now, blocking. E.g. before exit
+        while self.count:
+            if not self._output():                          # Stream is full
+                break
+
+    def _output(self):                                      # Write up to one chunk. Return the no. of bytes written
+        ri = self.ri
+        n = min(self.count, self.chunk, self.size - ri)
+        written = self.stream.write(self.mv[ri:ri + n])
+        if written is not None:                             # Stream may accept fewer bytes
+            n = written
+        if self.stream_flush is not None:
+            self.stream_flush()
+        self.ri = (ri + n) % self.size
+        self.count -= n
+        return n
+
+    def _drain(self):
+        yield
+        while True:
+            if not self.count:
+                self.await_obj.clear()
+                yield self.await_obj                        # Not polled until something is written
+            if self._output():
+                yield                                       # Round robin
+            else:
+                yield self.backoff()
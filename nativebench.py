@@ -0,0 +1,46 @@
+# nativebench.py Compare bytecode and native code versions of the usched hot paths
+# Author: Peter Hinch
+# Copyright Peter Hinch 2016 Released under the MIT license
+
+# Run on any MicroPython target, e.g. the unix port:
+# import nativebench
+# nativebench.test()
+# Prints the time per call of each function replaced by uschednative.py. Sched._get_thread is timed with
+# nthreads threads waiting on time delays, so every thread is polled on each call.
+# The SynCom bit loop is compared by syncom/bench.py: bench.bitloop().
+
+import usched
+from usched import Sched, Waitfor, Timeout
+from utime import ticks_us
+
+def _us(func, args, count):                     # Return time per call in us
+    tstart = ticks_us()
+    for _ in range(count):
+        func(*args)
+    return ((ticks_us() - tstart) & usched.TIMERPERIOD) / count
+
+def _waiting(delay):
+    while True:
+        yield delay
+
+def _functions(objSched, wf):                   # (name, function, args) for each current function
+    return (('after', usched.after, (usched.microsWhen(0),)),
+            ('microsWhen', usched.microsWhen, (1000,)),
+            ('triggered', Waitfor.triggered, (wf,)),
+            ('_get_thread', Sched._get_thread, (objSched,)))
+
+def test(count=1000, nthreads=10):
+    objSched = Sched(gc_enable=False)
+    for _ in range(nthreads):
+        objSched.add_thread(_waiting(10))
+    wf = Timeout(10)
+    if usched.bytecode is None:
+        print('Native code is unavailable: bytecode timings only.')
+        for name, func, args in _functions(objSched, wf):
+            print('{:12s} {:7.2f}us'.format(name, _us(func, args, count)))
+        return
+    print('{:12s} {:>9s} {:>9s} {:>7s}'.format('function', 'bytecode', 'native', 'speedup'))
+    for (name, func, args), bfunc in zip(_functions(objSched, wf), usched.bytecode):
+        tn = _us(func, args, count)
+        tb = _us(bfunc, args, count)
+        print('{:12s} {:7.2f}us {:7.2f}us {:7.2f}'.format(name, tb, tn, tb / tn))
@@ -0,0 +1,106 @@
+# profiler.py Statistical sampling profiler for the usched scheduler
+# Author: Peter Hinch
+# Copyright Peter Hinch 2016 Released under the MIT license
+
+from array import array
+from sys import platform
+
+# ************************************************* PROFILER CLASS **************************************************
+
+# A periodic timer interrupt samples Sched.current, the pid of the thread being run, and increments its entry in a
+# preallocated table. Samples taken while no thread is running (scheduling, garbage collection and waiting for a
+# thread to become due) are counted against pid 0. Threads with a pid > maxpid share slot maxpid + 1. The cost to
+# the scheduler is two attribute assignments per thread run; the sampler does not allocate.
+# On the Pyboard hardware timer no. timer is used, on ESP8266 a virtual timer. Elsewhere (unix port or CPython)
+# SIGPROF is raised by an interval timer. Here the signal handler is passed the interrupted frame, so the function
+# and line being executed may also be counted: pass lines=N where N is the maximum no. of lines to record.
+# Counts are held in 30 bit small ints: at 1KHz sampling they overflow after 12 days.
+
+class Profiler(object):
+    def __init__(self, objSched, freq=1000, maxpid=32, timer=14, lines=0):
+        if lines and platform in ('pyboard', 'esp8266'):
+            raise ValueError('Line sampling is not supported on this platform')
+        self.objsched = objSched
+        self.freq = freq
+        self.maxpid = maxpid
+        self.counts = array('I', [0] * (maxpid + 2))   # Samples per pid
+        self.maxlines = lines
+        self.lines = {}                                 # (pid, function, line no.): samples
+        self.overflow = 0                               # Line samples discarded: table full
+        self.timerno = timer
+        self.timer = None
+        self.signal = None
+        self._cb = self._sample                         # Bound method allocated here, not in the ISR
+
+    def _sample(self, _):
+        pid = self.objsched.current
+        if pid > self.maxpid:
+            pid = self.maxpid + 1
+        self.counts[pid] += 1
+
+    def _handler(self, signum, frame):                  # Host: signal handler
+        self._sample(signum)
+        if self.maxlines:
+            key = (self.objsched.current, frame.f_code.co_name, frame.f_lineno)
+            if key in self.lines:
+                self.lines[key] += 1
+            elif len(self.lines) < self.maxlines:
+                self.lines[key] = 1
+            else:
+                self.overflow += 1
+
+    def start(self):
+        if self.timer is not None or self.signal is not None:
+            return
+        if platform == 'pyboard':
+            import pyb
+            self.timer = pyb.Timer(self.timerno, freq=self.freq, callback=self._cb)
+        elif platform == 'esp8266':
+            import machine
+            self.timer = machine.Timer(-1)
+            self.timer.init(period=max(1, 1000 // self.freq), mode=machine.Timer.PERIODIC, callback=self._cb)
+        else:
+            try:
+                import signal
+                signal.signal(signal.SIGPROF, self._handler)
+                signal.setitimer(signal.ITIMER_PROF, 1 / self.freq, 1 / self.freq)
+            except (ImportError, AttributeError):
+                raise OSError('No timer available on this platform')
+            self.signal = signal
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.deinit()
+            self.timer = None
+        elif self.signal is not None:
+            self.signal.setitimer(self.signal.ITIMER_PROF, 0)
+            self.signal.signal(self.signal.SIGPROF, self.signal.SIG_DFL)
+            self.signal = None
+
+    def reset(self):
+        for pid in range(len(self.counts)):
+            self.counts[pid] = 0
+        self.lines = {}
+        self.overflow = 0
+
+    def samples(self):
+        return sum(self.counts)
+
+    def shares(self):                                   # Return {pid: percentage of samples}
+        total = self.samples()
+        if total == 0:
+            return {}
+        return {pid: 100 * n / total for pid, n in enumerate(self.counts) if n}
+
+    def report(self, nlines=10):                        # Print CPU share by thread and the busiest lines
+        total = self.samples()
+        print('{:>5} {:>8} {:>6}'.format('pid', 'samples', '%'))
+        for pid, share in sorted(self.shares().items(), key=lambda x: -x[1]):
+            name = 'sched' if pid == 0 else '>' + str(self.maxpid) if pid > self.maxpid else str(pid)
+            print('{:>5} {:>8} {:>6.1f}'.format(name, self.counts[pid], share))
+        if self.maxlines and total:
+            print('{:>5} {:>8} {:>6}  {}'.format('pid', 'samples', '%', 'function:line'))
+            for key, n in sorted(self.lines.items(), key=lambda x: -x[1])[:nlines]:
+                print('{:>5} {:>8} {:>6.1f}  {}:{}'.format(key[0], n, 100 * n / total, key[1], key[2]))
+            if self.overflow:
+                print('{} samples not recorded: line table full'.format(self.overflow))
@@ -28,7 +28,8 @@ class Pushbutton(object):
             true_func = None, true_func_args = (),
             false_func = None, false_func_args = (),
             long_func = None, long_func_args = (),
-            double_func = None, double_func_args =()):
+            double_func = None, double_func_args =(),
+            scanner = None, queue = None):
         self.pin = pyb.Pin(pinName, pyb.Pin.IN, desc['pull']) # Initialise for input
         self.desc = desc                                    # Button descriptor
         self.objSched = objSched
@@ -40,9 +41,20 @@ class Pushbutton(object):
         self.long_func_args = long_func_args
         self.double_func = double_func
         self.double_func_args = double_func_args
+        self.queue = queue                                  # Optional EventQueue for deferred callbacks
         self.sense = not desc['no']^desc['grounded']        # Conversion from electrical to logical value
         self.buttonstate = self.rawstate()                  # Initial state
-        objSched.add_thread(self.buttoncheck())             # Thread runs forever
+        if long_func:
+            if queue is None:
+                self.longdelay = Delay(objSched, long_func, long_func_args)
+            else:
+                self.longdelay = Delay(objSched, queue.put, (long_func, long_func_args))
+        if double_func:
+            self.doubledelay = Delay(objSched)
+        if scanner is None:
+            objSched.add_thread(self.buttoncheck())         # Thread runs forever
+        else:
+            scanner.add(self.pin, self.pinchange)           # Scanner's thread polls the pin
 
     def rawstate(self):                                     # Current non-debounced logical button state
         return bool(self.pin.value() ^ self.sense)          # True == pressed
@@ -50,31 +62,36 @@ class Pushbutton(object):
     def __call__(self):
         return self.buttonstate                             # Current debounced state of switch (True = pressed)
 
+    def _call(self, func, args):                            # Run or queue a callback
+        if self.queue is None:
+            func(*args)
+        else:
+            self.queue.put(func, args)
+
+    def pinchange(self, value):                             # Called by a Scanner with a debounced pin value
+        self.update(bool(value ^ self.sense))
+
+    def update(self, state):                                # Act on a debounced logical state
+        if state != self.buttonstate:                       # State has changed: act on it now.
+            self.buttonstate = state
+            if state:                                       # Button has been pressed
+                if self.long_func and not self.longdelay.running():
+                    self.longdelay.trigger(self.desc['long_press_time']) # Start long press delay
+                if self.double_func:
+                    if self.doubledelay.running():
+                        self._call(self.double_func, self.double_func_args)
+                    else:                                   # First click: start doubleclick timer
+                        self.doubledelay.trigger(self.desc['double_click_time'])
+                if self.true_func:
+                    self._call(self.true_func, self.true_func_args)
+            else:                                           # Button release
+                if self.long_func and self.longdelay.running():
+                    self.longdelay.stop()                   # Avoid interpreting a second click as a long push
+                if self.false_func:
+                    self._call(self.false_func, self.false_func_args)
+
     def buttoncheck(self):                                  # Generator object: thread which tests and debounces
         wf = Timeout(self.desc['debounce'])
-        state_id = 0
-        if self.long_func:
-            longdelay = Delay(self.objSched, self.long_func, self.long_func_args)
-        if self.double_func:
-            doubledelay = Delay(self.objSched)
         while True:
-            state = self.rawstate()
-            if state != self.buttonstate:                   # State has changed: act on it now.
-                self.buttonstate = state
-                if state:                                   # Button has been pressed
-                    if self.long_func and not longdelay.running():
-                        longdelay.trigger(self.desc['long_press_time']) # Start long press delay
-                    if self.double_func:
-                        if doubledelay.running():
-                            self.double_func(*self.double_func_args)
-                        else:                               # First click: start doubleclick timer
-                            doubledelay.trigger(self.desc['double_click_time'])
-                    if self.true_func:
-                        self.true_func(*self.true_func_args)
-                else:                                       # Button release
-                    if self.long_func and longdelay.running():
-                        longdelay.stop()                    # Avoid interpreting a second click as a long push
-                    if self.false_func:
-                        self.false_func(*self.false_func_args)
+            self.update(self.rawstate())
             yield wf()                                      # Ignore further state changes until switch has settled
-
@@ -0,0 +1,75 @@
+# scanner.py Debounces many Switch and Pushbutton inputs in a single thread
+# Author: Peter Hinch
+# Copyright Peter Hinch 2016 Released under the MIT license
+
+from usched import Timeout
+try:
+    import stm                                              # Pyboard: read whole GPIO ports
+except ImportError:
+    stm = None
+
+# ************************************************** SCANNER CLASS **************************************************
+
+# Each Switch or Pushbutton normally runs its own thread polling one pin. Where there are many inputs a Scanner
+# replaces these with one thread. Pins are grouped by GPIO port: on the Pyboard each port's input data register is
+# read once per scan and all pins on that port are debounced together as a bitmask. On other platforms pins are
+# read individually but the debouncing is still performed on a bitmask. The device's callback only runs for bits
+# which have changed. As with the individual drivers, debouncing is achieved by the sampling interval.
+
+class Scanner(object):
+    MAXBITS = 30                                            # Pins per pseudo port: avoid long integers
+    def __init__(self, objSched, debounce=0.02):
+        self.ports = []                                     # [address, mask, state, pins, clients]
+        self.lookup = dict()                                # GPIO address -> port
+        objSched.add_thread(self.scan(debounce))            # Thread runs forever
+
+    def add(self, pin, func):                               # func is called with the new pin value (0 or 1)
+        addr = None
+        if stm is not None:
+            addr = pin.gpio()
+            bit = 1 << pin.pin()
+            port = self.lookup.get(addr)
+            if port is None:
+                port = [addr, 0, 0, [], []]
+                self.lookup[addr] = port
+                self.ports.append(port)
+        else:                                               # Bits are allocated in order so can't detect a repeat
+            for port in self.ports:
+                if pin in port[3]:
+                    raise ValueError('Pin is already scanned')
+            port = self.ports[-1] if self.ports else None
+            if port is None or len(port[3]) == Scanner.MAXBITS:
+                port = [None, 0, 0, [], []]
+                self.ports.append(port)
+            bit = 1 << len(port[3])
+        if port[1] & bit:
+            raise ValueError('Pin is already scanned')
+        port[1] |= bit                                      # Mask of bits in use
+        if pin.value():
+            port[2] |= bit                                  # Initial state
+        port[3].append(pin)
+        port[4].append((bit, func))
+
+    def _read(self, port):                                  # Return bitmask of current pin values
+        if port[0] is not None:
+            return stm.mem16[port[0] + stm.GPIO_IDR] & port[1]
+        raw = 0
+        bit = 1
+        for pin in port[3]:
+            if pin.value():
+                raw |= bit
+            bit <<= 1
+        return raw
+
+    def scan(self, debounce):                               # Generator object: thread which tests and debounces
+        wf = Timeout(debounce)
+        while True:
+            for port in self.ports:
+                raw = self._read(port)
+                changed = raw ^ port[2]
+                if changed:                                 # State has changed: act on it now.
+                    port[2] = raw
+                    for bit, func in port[4]:
+                        if changed & bit:
+                            func(1 if raw & bit else 0)
+            yield wf()                                      # Ignore further state changes until switches have settled
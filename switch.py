@@ -16,27 +16,40 @@ from usched import Timeout
 
 class Switch(object):
     DEBOUNCETIME = 0.02
-    def __init__(self, objSched, pinName, close_func=None, close_func_args=(), open_func=None, open_func_args=()):
+    def __init__(self, objSched, pinName, close_func=None, close_func_args=(), open_func=None, open_func_args=(),
+                 scanner=None, queue=None):
         self.pin = pyb.Pin(pinName, pyb.Pin.IN, pyb.Pin.PULL_UP) # Initialise for input, switch to ground
         self.close_func = close_func
         self.close_func_args = close_func_args
         self.open_func = open_func
         self.open_func_args = open_func_args
+        self.queue = queue                                  # Optional EventQueue for deferred callbacks
         self.switchstate = self.pin.value()                 # Get initial state
-        objSched.add_thread(self.switchcheck())             # Thread runs forever
+        if scanner is None:
+            objSched.add_thread(self.switchcheck())         # Thread runs forever
+        else:
+            scanner.add(self.pin, self.update)              # Scanner's thread polls the pin
 
     def __call__(self):
         return self.switchstate                             # Return current state of switch (0 = pressed)
 
+    def _call(self, func, args):                            # Run or queue a callback
+        if self.queue is None:
+            func(*args)
+        else:
+            self.queue.put(func, args)
+
+    def update(self, state):                                # Act on a debounced pin value
+        if state != self.switchstate:                       # State has changed: act on it now.
+            self.switchstate = state
+            if state == 0 and self.close_func:
+                self._call(self.close_func, self.close_func_args)
+            elif state == 1 and self.open_func:
+                self._call(self.open_func, self.open_func_args)
+
     def switchcheck(self):                                  # Generator object: thread which tests and debounces
         wf = Timeout(Switch.DEBOUNCETIME)
         while True:
-            state = self.pin.value()
-            if state != self.switchstate:                   # State has changed: act on it now.
-                self.switchstate = state
-                if state == 0 and self.close_func:
-                    self.close_func(*self.close_func_args)
-                elif state == 1 and self.open_func:
-                    self.open_func(*self.open_func_args)
+            self.update(self.pin.value())
             yield wf()                                      # Ignore further state changes until switch has settled
 
@@ -0,0 +1,224 @@
+# bench.py SynCom throughput and latency benchmark.
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Peter Hinch
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Run on the unix port of MicroPython (built with thread support):
+# import bench
+# bench.test()
+# Both ends run in one process, each under its own scheduler in its own
+# thread, connected by simulated pins. The passive end echoes every message.
+# For each payload size and latency setting the initiator first times count
+# round trips one at a time, then sends count messages as fast as the link
+# accepts them and collects the echoes. Results are for the host: absolute
+# figures on a target will differ but the effect of the settings is similar.
+# With loop=True the in-memory Loopback transport replaces the simulated
+# pins and both ends share one scheduler: this measures the overhead of the
+# protocol layer alone.
+# bench.bitloop() times the bit loop alone, comparing the bytecode and native
+# code versions where the native code emitter is available.
+
+import gc
+import _thread
+from utime import ticks_us
+from usched import Sched
+import syncom
+from syncom import SynCom, Link, BitBang, BINARY, BLOCK, ticksdiff
+from simpins import simlink
+from transports import loopback
+
+# Messages in flight. With the BLOCK policy a link stalls while its rx queue is
+# full: if both ends fill their queues the echo cannot be sent and the link
+# locks up, so the window must not exceed the queue depths.
+_WINDOW = const(4)
+_TIMEOUT = const(200000)
+
+def _check(data, size):  # Payloads hold a byte pattern: check without allocating
+    return len(data) == size and (size == 0 or data[-1] == (size - 1) & 0xff)
+
+def _percentile(data, pc):  # data is sorted
+    return data[min(len(data) - 1, len(data) * pc // 100)]
+
+def _mem_alloc():
+    try:
+        return gc.mem_alloc()
+    except AttributeError:  # Not available: allocation is not reported
+        return None
+
+# ends is a pair of transports or, if loop is False, a pair of pin tuples.
+def _link(objsched, passive, ends, latency, loop):
+    kwargs = {'verbose': False, 'framing': BINARY, 'policy': BLOCK}
+    if loop:
+        return Link(objsched, ends[passive], **kwargs)
+    link = SynCom(objsched, passive, *ends[passive], latency=latency, **kwargs)
+    link.set_timeout(_TIMEOUT)      # Passive end stops when the initiator does
+    return link
+
+def _echo(chan):
+    yield
+    while True:
+        yield chan.await_obj
+        data = chan.get_bytes()
+        if data is None:            # Link has stopped
+            return
+        while not chan.send_bytes(data):
+            yield chan.await_tx
+
+def _stopper(objsched, state):
+    while not state['done']:
+        yield 0.01
+    objsched.stop()
+
+def _passive(chan, state, lock):
+    objsched = chan.objsched
+    chan.start()
+    objsched.add_thread(_echo(chan))
+    objsched.add_thread(_stopper(objsched, state))
+    try:
+        objsched.run()
+    finally:
+        lock.release()
+
+def _initiator(chan, size, count, state):
+    yield
+    payload = bytes(i & 0xff for i in range(size))
+    rtt = state['rtt']
+    while not chan.running():
+        yield 0.01
+    errors = 0
+    for _ in range(count):              # Round trip time
+        tstart = ticks_us()
+        chan.send_bytes(payload)
+        yield chan.await_obj
+        if not chan.running():
+            break
+        if not _check(chan.get_bytes(), size):
+            errors += 1
+        rtt.append(ticksdiff(tstart, ticks_us()))
+    a0 = _mem_alloc()
+    tstart = ticks_us()
+    sent = received = 0
+    while received < count:             # Throughput: keep the link busy
+        while sent < count and sent - received < _WINDOW:
+            chan.send_bytes(payload)
+            sent += 1
+        yield chan.await_obj
+        if not chan.running():
+            break
+        while chan.any():
+            if not _check(chan.get_bytes(), size):
+                errors += 1
+            received += 1
+    else:
+        state['elapsed'] = ticksdiff(tstart, ticks_us())
+    a1 = _mem_alloc()
+    state['alloc'] = None if a0 is None else a1 - a0
+    state['errors'] = errors
+    state['done'] = True
+    chan.objsched.stop()
+
+# Run one test: return a dict of results.
+def run(size=32, latency=5, count=50, loop=False):
+    gc.collect()
+    state = {'done': False, 'rtt': [], 'elapsed': 0, 'alloc': None,
+             'errors': 0}
+    ends = loopback(512) if loop else simlink()
+    isched = Sched(gc_enable=False)
+    psched = isched if loop else Sched(gc_enable=False)
+    pchan = _link(psched, True, ends, latency, loop)
+    ichan = _link(isched, False, ends, latency, loop)
+    lock = _thread.allocate_lock()
+    lock.acquire()
+    if loop:                            # One scheduler runs both ends
+        pchan.start()
+        isched.add_thread(_echo(pchan))
+        lock.release()
+    else:
+        _thread.start_new_thread(_passive, (pchan, state, lock))
+    ichan.start()
+    isched.add_thread(_initiator(ichan, size, count, state))
+    gc.disable()                        # Allocation is measured, not collected
+    try:
+        isched.run()
+    finally:
+        state['done'] = True
+        lock.acquire()                  # Wait for the passive end to stop
+        gc.enable()
+    if not state['elapsed']:
+        raise OSError('Link failed')
+    rtt = sorted(state['rtt'])
+    elapsed = state['elapsed']
+    alloc = state['alloc']
+    return {'size': size, 'latency': latency, 'count': count,
+            'bytes_s': 2 * count * size * 1000000 // elapsed,
+            'msgs_s': 2 * count * 1000000 // elapsed,
+            'rtt_p50': _percentile(rtt, 50), 'rtt_p90': _percentile(rtt, 90),
+            'rtt_p99': _percentile(rtt, 99), 'rtt_max': rtt[-1],
+            'alloc_msg': None if alloc is None else alloc // (2 * count),
+            'errors': state['errors']}
+
+# Rates count both directions. RTT figures are in us, alloc in bytes/message.
+def test(sizes=(8, 32, 128), latencies=(1, 5, 20), count=50, loop=False):
+    print('{:>5} {:>7} {:>9} {:>7} {:>8} {:>8} {:>8} {:>8} {:>6} {:>6}'.format(
+        'size', 'latency', 'bytes/s', 'msgs/s', 'rtt p50', 'rtt p90',
+        'rtt p99', 'rtt max', 'alloc', 'errors'))
+    for latency in ((0,) if loop else latencies):
+        for size in sizes:
+            r = run(size, latency, count, loop)
+            alloc = '-' if r['alloc_msg'] is None else r['alloc_msg']
+            print('{:>5} {:>7} {:>9} {:>7} {:>8} {:>8} {:>8} {:>8} {:>6} {:>6}'.format(
+                size, latency, r['bytes_s'], r['msgs_s'], r['rtt_p50'],
+                r['rtt_p90'], r['rtt_p99'], r['rtt_max'], alloc, r['errors']))
+
+class _Pin(object):  # Output looped back to input: the peer is always ready
+    def __init__(self):
+        self.level = 0
+
+    def __call__(self, v=None):
+        if v is None:
+            return self.level
+        self.level = v
+
+def _bytes_us(count):  # Time taken by the bit loop to transfer count bytes
+    ck, d = _Pin(), _Pin()
+    transport = BitBang(False, ck, ck, d, d)
+    transport.bits = 8
+    transport.odata = transport.phase = 0
+    tstart = ticks_us()
+    for _ in range(count):
+        transport._get_byte_active()
+    return ticksdiff(tstart, ticks_us())
+
+# Print the time in us to transfer a byte with and without native code.
+def bitloop(count=1000):
+    t = _bytes_us(count)
+    if syncom.bytecode is None:
+        print('Bytecode {:6.2f}us/byte. Native code is unavailable.'.format(t / count))
+        return
+    native = (BitBang._get_bit, BitBang._get_byte_active, BitBang._get_byte_passive)
+    BitBang._get_bit, BitBang._get_byte_active, BitBang._get_byte_passive = syncom.bytecode
+    try:
+        tb = _bytes_us(count)
+    finally:
+        BitBang._get_bit, BitBang._get_byte_active, BitBang._get_byte_passive = native
+    print('Bytecode {:6.2f}us/byte native {:6.2f}us/byte speedup {:4.2f}'.format(
+        tb / count, t / count, tb / t))
@@ -0,0 +1,221 @@
+# bincodec.py Compact binary serialisation for SynCom. An alternative to pickle.
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Peter Hinch
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# A codec is any object with dumps(obj) and loads(data) methods: the pickle
+# module is one. BinCodec has a binary attribute: its output may contain any
+# byte value so it requires SynCom's BINARY framing.
+# Each value is encoded as a one byte tag followed by its data, little endian.
+# Integers 0-127 are encoded in the tag byte. Lengths and item counts are
+# varints: 7 bits per byte, LS first, MSB set on all but the last byte.
+# Supports None, bool, int, float, str, bytes, bytearray, list, tuple, dict
+# and Record instances. A Record is encoded as its message ID followed by its
+# values packed with the struct format registered for that ID.
+
+try:
+    from ustruct import pack_into, unpack_from, calcsize
+except ImportError:
+    from struct import pack_into, unpack_from, calcsize
+
+_NONE = const(0)
+_TRUE = const(1)
+_FALSE = const(2)
+_INT8 = const(3)
+_INT16 = const(4)
+_INT32 = const(5)
+_INT64 = const(6)
+_FLOAT = const(7)
+_STR = const(8)
+_BYTES = const(9)
+_LIST = const(10)
+_TUPLE = const(11)
+_DICT = const(12)
+_RECORD = const(13)
+_SMALLINT = const(0x80)  # Tags 0x80-0xff hold integers 0-127
+
+class Record(object):
+    def __init__(self, msgid, values):
+        self.msgid = msgid
+        self.values = values
+
+    def __repr__(self):
+        return 'Record({}, {})'.format(self.msgid, self.values)
+
+class BinCodec(object):
+    binary = True
+
+    def __init__(self, bufsize=128, double=False):
+        self.buf = bytearray(bufsize)  # dumps() encodes into this
+        self.mv = memoryview(self.buf)
+        self.ffmt = '<d' if double else '<f'
+        self.fsize = calcsize(self.ffmt)
+        self.schemas = {}
+
+    def register(self, msgid, fmt):  # Fixed schema for Record instances
+        if not 0 <= msgid <= 255:
+            raise ValueError('Message ID must be 0-255')
+        if fmt[0] not in '<>!=@':
+            fmt = '<' + fmt
+        self.schemas[msgid] = (fmt, calcsize(fmt))
+
+# Return a memoryview of the encoded object. It is valid until the next call
+# to dumps: SynCom copies it immediately.
+    def dumps(self, obj):
+        try:
+            end = self._enc(obj, 0)
+        except IndexError:
+            raise ValueError('Object too large')
+        return self.mv[:end]
+
+    def loads(self, data):
+        return self._dec(data, 0)[0]
+
+    def _enc(self, obj, pos):  # Return position after encoded object
+        buf = self.buf
+        t = type(obj)
+        if obj is None:
+            buf[pos] = _NONE
+            return pos + 1
+        if t is bool:
+            buf[pos] = _TRUE if obj else _FALSE
+            return pos + 1
+        if t is int:
+            if 0 <= obj <= 0x7f:
+                buf[pos] = _SMALLINT | obj
+                return pos + 1
+            if -0x80 <= obj <= 0x7f:
+                return self._pack(_INT8, '<b', 1, pos, obj)
+            if -0x8000 <= obj <= 0x7fff:
+                return self._pack(_INT16, '<h', 2, pos, obj)
+            if -0x80000000 <= obj <= 0x7fffffff:
+                return self._pack(_INT32, '<i', 4, pos, obj)
+            if -0x8000000000000000 <= obj <= 0x7fffffffffffffff:
+                return self._pack(_INT64, '<q', 8, pos, obj)
+            raise ValueError('Integer out of range')
+        if t is float:
+            return self._pack(_FLOAT, self.ffmt, self.fsize, pos, obj)
+        if t is str:
+            return self._enc_bytes(obj.encode(), pos, _STR)
+        if t is bytes or t is bytearray:
+            return self._enc_bytes(obj, pos, _BYTES)
+        if t is list or t is tuple or t is dict:
+            pos = self._enc_len(len(obj), pos, _LIST if t is list else _TUPLE if t is tuple else _DICT)
+            if t is dict:
+                for key in obj:
+                    pos = self._enc(key, pos)
+                    pos = self._enc(obj[key], pos)
+            else:
+                for item in obj:
+                    pos = self._enc(item, pos)
+            return pos
+        if t is Record:
+            try:
+                fmt, size = self.schemas[obj.msgid]
+            except KeyError:
+                raise ValueError('Unregistered message ID {}'.format(obj.msgid))
+            buf[pos] = _RECORD
+            return self._pack(obj.msgid, fmt, size, pos + 1, *obj.values)
+        raise ValueError('Cannot encode {}'.format(t))
+
+    def _pack(self, tag, fmt, size, pos, *values):  # Tag followed by struct data
+        end = pos + 1 + size
+        if end > len(self.buf):     # pack_into would raise struct.error
+            raise IndexError
+        self.buf[pos] = tag
+        pack_into(fmt, self.buf, pos + 1, *values)
+        return end
+
+    def _enc_len(self, n, pos, tag):  # Tag followed by varint
+        buf = self.buf
+        buf[pos] = tag
+        pos += 1
+        while n > 0x7f:
+            buf[pos] = (n & 0x7f) | 0x80
+            n >>= 7
+            pos += 1
+        buf[pos] = n
+        return pos + 1
+
+    def _enc_bytes(self, data, pos, tag):
+        n = len(data)
+        pos = self._enc_len(n, pos, tag)
+        end = pos + n
+        if end > len(self.buf):
+            raise IndexError
+        self.mv[pos:end] = data
+        return end
+
+    def _dec(self, data, pos):  # Return (object, position after it)
+        tag = data[pos]
+        pos += 1
+        if tag & _SMALLINT:
+            return tag & 0x7f, pos
+        if tag == _NONE:
+            return None, pos
+        if tag == _TRUE:
+            return True, pos
+        if tag == _FALSE:
+            return False, pos
+        if tag == _INT8:
+            return unpack_from('<b', data, pos)[0], pos + 1
+        if tag == _INT16:
+            return unpack_from('<h', data, pos)[0], pos + 2
+        if tag == _INT32:
+            return unpack_from('<i', data, pos)[0], pos + 4
+        if tag == _INT64:
+            return unpack_from('<q', data, pos)[0], pos + 8
+        if tag == _FLOAT:
+            return unpack_from(self.ffmt, data, pos)[0], pos + self.fsize
+        if tag == _RECORD:
+            msgid = data[pos]
+            try:
+                fmt, size = self.schemas[msgid]
+            except KeyError:
+                raise ValueError('Unregistered message ID {}'.format(msgid))
+            return Record(msgid, unpack_from(fmt, data, pos + 1)), pos + 1 + size
+        if tag > _DICT:
+            raise ValueError('Invalid data')
+        n = 0                       # Decode varint length
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            n |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        if tag == _STR:
+            return bytes(data[pos:pos + n]).decode(), pos + n
+        if tag == _BYTES:
+            return bytes(data[pos:pos + n]), pos + n
+        if tag == _DICT:
+            obj = {}
+            for _ in range(n):
+                key, pos = self._dec(data, pos)
+                obj[key], pos = self._dec(data, pos)
+            return obj, pos
+        obj = []
+        for _ in range(n):
+            item, pos = self._dec(data, pos)
+            obj.append(item)
+        return (obj if tag == _LIST else tuple(obj)), pos
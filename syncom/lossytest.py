@@ -0,0 +1,161 @@
+# lossytest.py Test SynCom recovery from corrupted frames.
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Peter Hinch
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Run on the unix port of MicroPython:
+# import lossytest
+# lossytest.test()
+# Two Links are connected by Loopback transports, one of which corrupts
+# chosen bytes of chosen message frames. The initiator sends numbered
+# messages and each test checks which arrive: a link which locks up fails.
+
+from usched import Sched
+from syncom import Link, BINARY, BLOCK
+from transports import Loopback
+
+_SOF = const(0x7e)
+_CREDIT = const(3)          # Type byte of a channel 0 credit frame
+_IDLE = const(50)           # Receiver stops after 50 idle passes of 10ms
+
+# Corrupts bytes of the frames it sends. faults maps (frame, offset) to the
+# value written, where frame counts frames with the given type byte (default
+# channel 0 messages) and offset 0 is the SOF. Payloads must not contain the
+# SOF byte.
+class _Lossy(Loopback):
+    def __init__(self, faults, size=256, passive=False, ftype=0):
+        super().__init__(size, passive)
+        self.faults = faults
+        self.ftype = ftype
+        self.frame = -1     # No. of current frame of type ftype
+        self.pos = -1       # Offset in current frame: -1 between frames
+        self.flen = 0       # Length of current frame
+        self.match = False
+
+    def write(self, buf, start, end):
+        peer = self.peer
+        wi = peer.wi
+        n = super().write(buf, start, end)
+        for k in range(n):
+            data = buf[start + k]
+            if self.pos < 0:
+                if data != _SOF:
+                    continue
+            self.pos += 1
+            pos = self.pos
+            if pos == 1:
+                self.match = data == self.ftype
+                if self.match:
+                    self.frame += 1
+            elif pos == 2:
+                self.flen = data
+            elif pos == 3:
+                self.flen = 4 + (self.flen | data << 8) + (2 if self.link.crc else 0)
+            if self.match:
+                value = self.faults.get((self.frame, pos))
+                if value is not None:
+                    peer.ring[(wi + k) % peer.size] = value
+            if pos >= 3 and pos == self.flen - 1:
+                self.pos = -1
+        return n
+
+def _sender(link, peer, count):
+    yield
+    while not (link.running() and peer.running()):
+        yield
+    for n in range(count):
+        data = bytes((n + 1,)) * 8
+        while not link.send_bytes(data):  # BLOCK policy: queue is full
+            yield link.await_tx
+
+def _receiver(link, count, got, objsched):
+    idle = 0
+    while len(got) < count and idle < _IDLE:
+        yield 0.01
+        idle += 1
+        data = link.get_bytes()
+        while data is not None:
+            got.append(data[0] - 1)
+            idle = 0
+            data = link.get_bytes()
+    objsched.stop()
+
+# Send count messages through a link with the given faults. Return a list
+# of the message numbers received and the receiving Link. If ftype is given
+# the faults apply to frames of that type sent by the receiver.
+def run(faults, count=10, ftype=None, **kwargs):
+    objsched = Sched(gc_enable=False)
+    if ftype is None:
+        ta = _Lossy(faults)
+        tb = Loopback(256, True)
+    else:
+        ta = Loopback(256)
+        tb = _Lossy(faults, 256, True, ftype)
+    ta.peer = tb
+    tb.peer = ta
+    kwargs.update(verbose=False, framing=BINARY, policy=BLOCK)
+    tx = Link(objsched, ta, **kwargs)
+    rx = Link(objsched, tb, **kwargs)
+    got = []
+    tx.start()
+    rx.start()
+    objsched.add_thread(_sender(tx, rx, count))
+    objsched.add_thread(_receiver(rx, count, got, objsched))
+    objsched.run()
+    return got, rx
+
+def _result(name, ok):
+    print('{:40s} {}'.format(name, 'pass' if ok else 'FAIL'))
+    return ok
+
+# A corrupt length MS byte must cost only its own frame.
+def test_length():
+    got, rx = run({(1, 3): 0xff})
+    return _result('Corrupt length', got == [0, 2, 3, 4, 5, 6, 7, 8, 9] and
+                   rx.stats()['rxdropped'] == 1)
+
+# With flow control a message lost to a CRC error, or dropped for a corrupt
+# length, must not take its credit with it: the link would stall once the
+# sender has used the rest.
+def test_crc():
+    got, rx = run({(1, 6): 0, (2, 7): 0}, crc=True, flow=True, rxdepth=2)
+    return _result('Flow control: CRC errors', got == [0, 3, 4, 5, 6, 7, 8, 9] and
+                   rx.stats()['crcerrors'] == 2)
+
+def test_flow_length():
+    got, rx = run({(1, 3): 0xff, (4, 3): 0xff}, crc=True, flow=True, rxdepth=2)
+    return _result('Flow control: corrupt length', got == [0, 2, 3, 5, 6, 7, 8, 9] and
+                   rx.stats()['rxdropped'] == 2)
+
+# Without a CRC a credit frame with a corrupt type byte is lost unnoticed:
+# the sender must probe for credit when it runs out.
+def test_credit():
+    got, rx = run({(2, 1): 0xf3, (3, 1): 0xf3}, count=20, ftype=_CREDIT, flow=True, rxdepth=2)
+    return _result('Flow control: lost credit', got == list(range(20)))
+
+def test():
+    ok = test_length()
+    ok = test_crc() and ok
+    ok = test_flow_length() and ok
+    ok = test_credit() and ok
+    print('All tests passed' if ok else 'Tests failed')
+    return ok
@@ -0,0 +1,58 @@
+# simpins.py Simulated pins for running SynCom without hardware.
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Peter Hinch
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# A SimPin behaves like a Pin as used by SynCom's polled engine: called with
+# no arg it returns the level, with an arg it sets it. Two SimPins sharing a
+# _Wire are the two ends of a connection. The two SynCom instances run under
+# separate schedulers in separate threads (see bench.py), for example on the
+# unix port of MicroPython. Pin interrupts are not simulated.
+
+from utime import sleep_us
+
+class _Wire(object):
+    def __init__(self):
+        self.level = 0
+
+class SimPin(object):
+    def __init__(self, wire):
+        self.wire = wire
+
+# A thread polling a pin waits for the other thread to change it: sleeping
+# releases the interpreter lock so that it can do so.
+    def __call__(self, v=None):
+        if v is None:
+            sleep_us(0)
+            return self.wire.level
+        self.wire.level = v
+
+    def value(self, v=None):
+        return self(v)
+
+# Return the pins for each end of a link as (ckin, ckout, din, dout) tuples:
+# initiator first. Each end's ckout drives the other's ckin, likewise data.
+def simlink():
+    ck0, ck1, d0, d1 = _Wire(), _Wire(), _Wire(), _Wire()
+    initiator = (SimPin(ck1), SimPin(ck0), SimPin(d1), SimPin(d0))
+    passive = (SimPin(ck0), SimPin(ck1), SimPin(d0), SimPin(d1))
+    return initiator, passive
@@ -25,10 +25,30 @@
 
 # Timing: 4.5mS per char between Pyboard and ESP8266 i.e. ~1.55Kbps
 # Now supports timeout
+# Framing: TEXT mode sends 7 bit characters, a frame being terminated by 0.
+# BINARY mode sends 8 bit characters. A frame comprises SOF, type, length
+# (2 bytes LS first), payload and an optional CRC16 (CCITT, LS first) of all
+# but the SOF. Bytes received between frames are ignored. The type byte holds
+# the channel number (bits 4-7) and the frame type (bits 0-3): 0 for a message,
+# 1 for a chunk of a stream, 2 for the end of a stream, 3 for a credit grant and
+# 4 for a credit grant sent by a channel which is out of credit: a probe.
+# With flow control a receiver grants credit for its free message and chunk
+# queue slots. A credit frame's payload holds four counts (mod 256): the number
+# of messages and of chunks the peer may have sent since the link started, then
+# the number of messages and of chunks the sender of the credit has sent. As
+# frames arrive in order the latter tell the peer how many of its data frames
+# were lost, so it can grant their credit again. A probe is answered with a
+# credit frame in case the last one sent was lost; it is repeated every 100ms
+# until credit arrives.
 
 import pickle
-from usched import Poller
+from array import array
+from usched import Poller, Event
 from utime import ticks_diff, ticks_us
+try:
+    from machine import disable_irq, enable_irq
+except ImportError:         # Only the interrupt driven engine needs these
+    disable_irq = enable_irq = None
 
 def tdiff():
     new_semantics = ticks_diff(2, 1) == 1
@@ -44,48 +64,552 @@ ticksdiff = tdiff()
 _BITS_PER_CH = const(7)
 _BITS_SYN = const(8)
 
+# Framing modes
+TEXT = const(0)
+BINARY = const(1)
+
+_SOF = const(0x7e)
+_OVERHEAD = const(6)    # Binary frame: SOF, type, length, CRC
+# Binary receive states
+_HUNT = const(0)
+_TYPE = const(1)
+_LEN0 = const(2)
+_LEN1 = const(3)
+_DATA = const(4)
+_CRC0 = const(5)
+_CRC1 = const(6)
+# Binary frame types
+_MSG = const(0)
+_CHUNK = const(1)
+_END = const(2)
+_CREDIT = const(3)
+_PROBE = const(4)           # Credit frame which asks for one in reply
+_REPROBE = const(100000)    # us between probes while out of credit
+
+_crctable = None
+
+def _mkcrctable():  # Only built if a CRC is used
+    global _crctable
+    if _crctable is None:
+        _crctable = array('H', [0] * 256)
+        for n in range(256):
+            crc = n << 8
+            for _ in range(8):
+                crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+            _crctable[n] = crc & 0xffff
+    return _crctable
+
+# Queue overflow policies
+DROP_OLDEST = const(0)
+DROP_NEWEST = const(1)
+BLOCK = const(2)
+
 class SynComError(Exception):
     pass
 
-class SynCom(object):
-    syn = 0x9d
+def _msgtype(obj):  # Default dispatcher key
+    msgid = getattr(obj, 'msgid', None)
+    if msgid is not None:
+        return msgid
+    if isinstance(obj, (list, tuple)) and len(obj):
+        return obj[0]
+    return None
 
-    def __init__(self, objsched, passive, ckin, ckout, din, dout, latency=5,
-                 verbose=True):
+# Fixed capacity FIFO: put and get are O(1) and never allocate. Caller checks for full/empty.
+class _Queue(object):
+    def __init__(self, size):
+        self.buf = [None] * size
+        self.size = size
+        self.wi = 0                 # Write index
+        self.ri = 0                 # Read index
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return self.count >= self.size
+
+    def clear(self):
+        while self.count:
+            self.get()
+        self.wi = 0
+        self.ri = 0
+
+    def put(self, item):
+        self.buf[self.wi] = item
+        self.wi = (self.wi + 1) % self.size
+        self.count += 1
+
+    def get(self):              # Return oldest item
+        item = self.buf[self.ri]
+        self.buf[self.ri] = None    # Don't retain a reference
+        self.ri = (self.ri + 1) % self.size
+        self.count -= 1
+        return item
+
+# Pool of preallocated frame buffers identified by index. Its queue holds the
+# indices of complete frames awaiting transmission or collection. spare is the
+# number of buffers which may be in use outside the queue: one being sent, or
+# one being received plus one whose contents are lent to the application.
+class _Pool(object):
+    def __init__(self, depth, bufsize, spare):
+        n = depth + spare
+        self.bufsize = bufsize
+        self.bufs = [bytearray(bufsize) for _ in range(n)]
+        self.mvs = [memoryview(buf) for buf in self.bufs]
+        self.lens = array('H', [0] * n)
+        self.stamps = array('i', [0] * n)  # ticks_us when framed
+        self.free = _Queue(n)
+        for idx in range(n):
+            self.free.put(idx)
+        self.queue = _Queue(depth)
+        self.lent = -1
+
+    def alloc(self):            # Invariants ensure a buffer is free
+        return self.free.get()
+
+    def release(self, idx):
+        self.free.put(idx)
+
+    def clear(self):
+        while len(self.queue):
+            self.release(self.queue.get())
+
+    def lend(self, idx):        # Previously lent buffer may now be reused
+        if self.lent >= 0:
+            self.release(self.lent)
+        self.lent = idx
+
+    def frame(self, idx):
+        return self.mvs[idx][:self.lens[idx]]
+
+# A logical channel. It has its own queues, overflow policy and codec and
+# shares the physical link with other channels. A SynCom instance is channel 0.
+# Frames are sent in order of channel priority: a frame is never interrupted
+# so a high priority message waits at most for one frame in progress.
+class Channel(object):
+    def __init__(self, link, number, priority, txdepth, rxdepth, policy,
+                 streamdepth, codec):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError('Invalid overflow policy')
+        if link.flow and (rxdepth > 255 or streamdepth > 255):  # Credit counts are mod 256
+            raise ValueError('Flow control requires rxdepth and streamdepth <= 255')
+        self.link = link
+        self.number = number
+        self.priority = priority
+        self.policy = policy
+        self.codec = pickle if codec is None else codec  # Object serialisation
+        self.binary = getattr(self.codec, 'binary', False)  # Output is bytes
+        if self.binary and link.framing != BINARY:
+            raise ValueError('Codec requires BINARY framing')
+        bufsize = link.bufsize
+        overhead = _OVERHEAD if link.framing == BINARY else 1  # TEXT: terminator
+        self.txpool = _Pool(txdepth, bufsize + overhead, 1)  # Frames to send
+        self.rxpool = _Pool(rxdepth, bufsize, 2)  # Received payloads
+        self.chunkpool = None       # Received stream chunks
+        if link.framing == BINARY and streamdepth > 0:
+            self.chunkpool = _Pool(streamdepth, bufsize, 2)
+        self.txstream = None        # Iterator supplying outgoing chunks
+        self.txrest = None          # Unsent part of current chunk
+        self.txdropped = 0          # Overflow counts
+        self.rxdropped = 0
+        self.txpeak = 0             # Maximum queue depths
+        self.rxpeak = 0
+        self.txsent = 0             # Flow control: frames sent (mod 256)
+        self.chunksent = 0
+        self.txlimit = 0            # Limits granted by the peer
+        self.chunklimit = 0
+        self.grant = bytearray(4)   # Limits granted to the peer, frames sent
+        self.regrant = False        # grant has changed
+        self.rxcount = 0            # Data frames received or discarded (mod 256)
+        self.chunkcount = 0
+        self.probed = False         # Out of credit: peer has been sent our counts
+        self.probe = False          # Next credit frame is a probe
+        self.tprobe = 0             # Time of last probe
+
+        self.handlers = {}          # Message type: function
+        # Set by the link thread when data arrives: waiting threads are not polled
+        self.await_obj = Event()
+        self.await_tx = Poller(self._txpollfunc)
+        self.await_chunk = Event()
+
+# Queue an object for tx. Convert to string NOW: snapshot of current
+# object state. Return False if the queue was full and the object was not
+# queued.
+    def send(self, obj):
+        if self.binary:
+            return self.send_bytes(self.codec.dumps(obj))
+        return self.send_str(self.codec.dumps(obj))
+
+    def send_str(self, string):
+        return self.send_bytes(string.encode())
+
+    def send_bytes(self, data):  # Copy data into a preallocated buffer
+        pool = self.txpool
+        if len(data) > self.link.bufsize:
+            raise ValueError('Message too long')
+        txq = pool.queue
+        if txq.full():
+            if self.policy == BLOCK:  # Sender should yield await_tx and retry
+                return False
+            self.txdropped += 1
+            if self.policy == DROP_NEWEST:
+                return False
+            pool.release(txq.get())
+        txq.put(self._frame(data, _MSG))
+        if len(txq) > self.txpeak:
+            self.txpeak = len(txq)
+        return True
+
+# Generator: queue an object, waiting while the queue is full. Usage:
+# yield from chan.send_wait(obj)
+# Returns False if the link is not running and the queue is full.
+    def send_wait(self, obj):
+        while self.txpool.queue.full():
+            if not self.link._running:
+                return False
+            yield self.await_tx
+        return self.send(obj)
+
+# Send a stream of bytes objects supplied by an iterator (e.g. a generator
+# reading a file). Chunks are fetched only when the channel has no message to
+# send, so messages take priority and memory use is fixed. Chunks longer than
+# bufsize are split. Return False if a stream is already in progress.
+    def send_stream(self, source):
+        if self.link.framing != BINARY:
+            raise ValueError('Streaming requires BINARY framing')
+        if self.txstream is not None:
+            return False
+        self.txrest = None
+        self.txstream = iter(source)
+        return True
+
+    def streaming(self):        # True while a stream is being sent
+        return self.txstream is not None
+
+    def _frame(self, data, ftype, pool=None):  # Copy data into a free tx buffer
+        link = self.link
+        if pool is None:
+            pool = self.txpool
+        n = len(data)
+        idx = pool.alloc()
+        pool.stamps[idx] = ticks_us()
+        if link.framing == BINARY:
+            buf = pool.bufs[idx]
+            buf[0] = _SOF
+            buf[1] = (self.number << 4) | ftype
+            buf[2] = n & 0xff
+            buf[3] = n >> 8
+            end = n + 4
+            pool.mvs[idx][4:end] = data
+            if link.crc:
+                crc = link._crc(0xffff, buf, 1, end)
+                buf[end] = crc & 0xff
+                buf[end + 1] = crc >> 8
+                end += 2
+            pool.lens[idx] = end
+        else:
+            pool.mvs[idx][:n] = data
+            pool.bufs[idx][n] = 0   # Terminator
+            pool.lens[idx] = n + 1
+        return idx
+
+    def _next_frame(self):  # Return index of next frame to send or -1
+        if len(self.txpool.queue) and self.txsent != self.txlimit:
+            self.txsent = (self.txsent + 1) & 0xff
+            return self.txpool.queue.get()  # oldest first
+        if self.txstream is None or self.chunksent == self.chunklimit:
+            return -1
+        idx = self._next_chunk()
+        if idx >= 0:
+            self.chunksent = (self.chunksent + 1) & 0xff
+        return idx
+
+    def _txready(self):  # True if a frame can be sent
+        if len(self.txpool.queue) and self.txsent != self.txlimit:
+            return True
+        if self.txstream is not None and self.chunksent != self.chunklimit:
+            return True
+        if len(self.txpool.queue) or self.txstream is not None:
+            if self.probed and ticksdiff(self.tprobe, ticks_us()) < _REPROBE:
+                return False        # Answer may be on its way
+            self.probed = True      # Out of credit: send our counts so the peer
+            self.probe = True       # can detect lost frames and grant their credit
+            self.regrant = True
+            self.tprobe = ticks_us()
+        return False
+
+    def _next_chunk(self):
+        rest = self.txrest
+        if rest is None:
+            try:
+                rest = memoryview(next(self.txstream))
+            except StopIteration:
+                self.txstream = None
+                return self._frame(b'', _END)
+            if not len(rest):
+                return -1
+        bufsize = self.link.bufsize
+        if len(rest) > bufsize:
+            self.txrest = rest[bufsize:]
+            return self._frame(rest[:bufsize], _CHUNK)
+        self.txrest = None
+        return self._frame(rest, _CHUNK)
+
+    def any(self):
+        return len(self.rxpool.queue)
+
+    def _txpollfunc(self):
+        if self.link._running:
+            return None if self.txpool.queue.full() else 1
+        return 2
+
+    def get(self):
+        if self.any():
+            if self.binary:
+                return self.codec.loads(self.get_bytes())
+            return self.codec.loads(self.get_str())
+
+    def get_str(self):
+        if self.any():
+            return bytes(self.get_bytes()).decode()
+
+# Return a memoryview of a received frame. It is valid until the next call to
+# a get method: copy it if it is required for longer.
+    def get_bytes(self):
+        if self.any():
+            pool = self.rxpool
+            idx = pool.queue.get()
+            pool.lend(idx)
+            self._free(0)           # Slot is free
+            if not len(pool.queue) and self.link._running:
+                self.await_obj.clear()
+            return pool.frame(idx)
+
+# Return a memoryview of the next received stream chunk or None if there is
+# none. A zero length chunk marks the end of a stream. The view is valid until
+# the next call to get_chunk. While the chunk queue is full the link stalls so
+# that no stream data is lost.
+    def get_chunk(self):
+        pool = self.chunkpool
+        if pool is not None and len(pool.queue):
+            idx = pool.queue.get()
+            pool.lend(idx)
+            self._free(1)
+            if not len(pool.queue) and self.link._running:
+                self.await_chunk.clear()
+            return pool.frame(idx)
+
+# Register a function to be run by the dispatcher thread for received
+# messages of a given type. A msgtype of None handles messages of any type
+# without a handler of their own. func receives the message object.
+    def handler(self, func, msgtype=None):
+        self.handlers[msgtype] = func
+
+# Generator object: thread which runs handlers. key(obj) returns a message's
+# type: by default a Record's msgid or the first element of a list or tuple.
+# Messages with no handler are discarded.
+    def dispatcher(self, key=None):
+        if key is None:
+            key = _msgtype
+        handlers = self.handlers
+        yield
+        while True:
+            reason = yield self.await_obj
+            if reason[1] == 2:      # Link has failed: wait for a restart
+                yield 0.1
+                continue
+            while self.any():
+                obj = self.get()
+                func = handlers.get(key(obj))
+                if func is None:
+                    func = handlers.get(None)
+                if func is not None:
+                    func(obj)
+            yield                   # Let roundrobin threads run between batches
+
+    def _free(self, n):  # Flow control: grant a freed message (0) or chunk (1) slot
+        self.grant[n] = (self.grant[n] + 1) & 0xff
+        self.regrant = True
+
+    def _credit(self, grant, probe):  # Process a credit frame from the peer
+        if grant[0] != self.txlimit or grant[1] != self.chunklimit:
+            self.probed = False     # Progress: may probe again when out of credit
+        self.txlimit = grant[0]
+        self.chunklimit = grant[1]
+        lost = (grant[2] - self.rxcount) & 0xff  # Peer's frames which never arrived
+        if lost:
+            self.rxcount = grant[2]
+            self.grant[0] = (self.grant[0] + lost) & 0xff
+            self.regrant = True
+        lost = (grant[3] - self.chunkcount) & 0xff
+        if lost:
+            self.chunkcount = grant[3]
+            self.grant[1] = (self.grant[1] + lost) & 0xff
+            self.regrant = True
+        if probe:                   # Peer is out of credit: the last credit
+            self.regrant = True     # frame it was sent may have been lost
+
+    def _clear(self):  # Discard received data
+        self.rxpool.clear()
+        if self.chunkpool is not None:
+            self.chunkpool.clear()
+        self.await_obj.clear()
+        self.await_chunk.clear()
+        self.txsent = self.chunksent = 0  # Restart flow control
+        self.rxcount = self.chunkcount = 0
+        self.probed = self.probe = False
+        if self.link.flow:          # Peer may send nothing until granted
+            self.txlimit = self.chunklimit = 0
+            self.grant[0] = self.rxpool.queue.size
+            self.grant[1] = 0 if self.chunkpool is None else self.chunkpool.queue.size
+            self.regrant = True
+        else:                       # Unlimited: sent never reaches limit
+            self.txlimit = self.chunklimit = -1
+
+# The protocol layer. A Link exchanges frames with its peer over a transport
+# which moves bytes. A transport provides:
+# passive    Role: only affects console messages.
+# polled     True if pump must be called on every pass of the link thread.
+# hold       Set by the Link while a frame is partly written: the transport
+#            must not send idle bytes until more data is written.
+# bind(link) Called by the Link constructor. The transport may read the
+#            link's framing and timeout attributes.
+# connect()  Generator run by the link thread: establishes the link.
+# pump()     Called on each pass of the link thread. Moves data if the
+#            transport has no hardware or interrupt support. May block.
+# write(buf, start, end) Queue buf[start:end]. Return the no. of bytes taken.
+# readinto(buf) Copy received bytes into buf. Return the number copied.
+# any()      Nonzero if received data or an event needs attention.
+# writable() True if write would accept data.
+# timedout() True if the peer has not responded within link.timeout us.
+# close()    Stop the transport.
+# stats(d, reset) Optional. Add transport statistics to dict d, clearing them
+#            if reset is True.
+class Link(Channel):
+    def __init__(self, objsched, transport, verbose=True, txdepth=8,
+                 rxdepth=8, policy=DROP_OLDEST, bufsize=128, framing=TEXT,
+                 crc=False, codec=None, streamdepth=2, flow=False):
         self.objsched = objsched
-        self.passive = passive
-        self.latency = max(latency, 1)  # No. of bytes between scheduler yield
+        self.transport = transport
+        self.passive = transport.passive
+        self.throughput = 0         # Characters received per second
+        self.output = print
+        if hasattr(verbose, 'print'):  # A Logger: false when empty
+            self.output = verbose.print
+            verbose = True
         self.verbose = verbose
         self.pid = None             # of _run thread
         if verbose:
             self.idstr = 'passive' if self.passive else 'initiator'
 
-        self.ckin = ckin            # Interface pins
-        self.ckout = ckout
-        self.din = din
-        self.dout = dout
-
         self.timeout = 0            # No timeout
 
-        self.lsttx = []             # Queue of strings to send
-        self.lstrx = []             # Queue of received strings
+        if framing not in (TEXT, BINARY):
+            raise ValueError('Invalid framing mode')
+        self.framing = framing
+        self.crc = crc and framing == BINARY
+        if self.crc:
+            self.crctable = _mkcrctable()
+        self.bufsize = bufsize      # Maximum payload
+        self.crcerrors = 0
+        if flow and framing != BINARY:
+            raise ValueError('Flow control requires BINARY framing')
+        self.flow = flow
+        # Credit frames: one being sent and one being received
+        self.ctlpool = _Pool(1, 4 + _OVERHEAD, 1) if flow else None
+        super().__init__(self, 0, 0, txdepth, rxdepth, policy, streamdepth, codec)
+        self.chans = [None] * 16    # Channels indexed by number
+        self.chans[0] = self
+        self.bypriority = [self]    # Channels in order of transmission
+        self.txidx = -1             # Buffer being sent. -1: none
+        self.txsrc = None           # Pool which owns it
+        self.rxchars = bytearray(32)  # Received characters
+        self.txover = 1 if framing == TEXT else 6 if self.crc else 4  # Framing bytes
+        self._zero()
+        self.await_link = Poller(self._linkpoll)
+        self._running = False
+        transport.bind(self)
+
+# Create a logical channel. Both ends of the link must create the same
+# channel numbers. Priority only affects transmission so may differ.
+    def channel(self, number, priority=0, txdepth=4, rxdepth=4, policy=None,
+                streamdepth=0, codec=None):
+        if self.framing != BINARY:
+            raise ValueError('Channels require BINARY framing')
+        if not 0 < number < 16:
+            raise ValueError('Channel number must be 1-15')
+        if self.chans[number] is not None:
+            raise ValueError('Channel {} already exists'.format(number))
+        chan = Channel(self, number, priority, txdepth, rxdepth,
+                       self.policy if policy is None else policy, streamdepth,
+                       self.codec if codec is None else codec)
+        self.chans[number] = chan
+        self.bypriority.append(chan)
+        self.bypriority.sort(key=lambda c: (-c.priority, c.number))
+        return chan
+
+    def _zero(self):  # Clear statistics
+        self.txframes = 0
+        self.rxframes = 0
+        self.txbytes = 0            # Payload bytes
+        self.rxbytes = 0
+        self.txcredits = 0          # Credit and probe frames
+        self.rxcredits = 0
+        self.timeouts = 0
+        self.syncs = 0
+        self.crcerrors = 0
+        self.lat_min = 0            # Time from queueing a frame to sending its last byte
+        self.lat_max = 0
+        self.lat_avg = 0            # Smoothed: a sum would become a long int
+        for chan in self.bypriority:
+            chan.txpeak = chan.rxpeak = 0
+            chan.txdropped = chan.rxdropped = 0
 
-        self.await_obj = Poller(self._pollfunc)
+# Return a dict of statistics accumulated since the link was created or since
+# the last call with reset True, which zeroes all counters including crcerrors
+# and the channels' dropped counts. Queue counts are totals over all channels.
+    def stats(self, reset=False):
+        d = {'txframes': self.txframes, 'rxframes': self.rxframes,
+             'txbytes': self.txbytes, 'rxbytes': self.rxbytes,
+             'txcredits': self.txcredits, 'rxcredits': self.rxcredits,
+             'timeouts': self.timeouts, 'syncs': self.syncs,
+             'crcerrors': self.crcerrors, 'throughput': self.throughput,
+             'latency_min': self.lat_min, 'latency_avg': self.lat_avg,
+             'latency_max': self.lat_max}
+        txq = rxq = txpeak = rxpeak = txdropped = rxdropped = 0
+        for chan in self.bypriority:
+            txq += len(chan.txpool.queue)
+            rxq += len(chan.rxpool.queue)
+            txpeak = max(txpeak, chan.txpeak)
+            rxpeak = max(rxpeak, chan.rxpeak)
+            txdropped += chan.txdropped
+            rxdropped += chan.rxdropped
+        d['txqueue'] = txq
+        d['rxqueue'] = rxq
+        d['txpeak'] = txpeak
+        d['rxpeak'] = rxpeak
+        d['txdropped'] = txdropped
+        d['rxdropped'] = rxdropped
+        if hasattr(self.transport, 'stats'):
+            self.transport.stats(d, reset)
+        if reset:
+            self._zero()
+        return d
 
     def init(self):
         self._running = True        # False on failure
-        self.indata = 0             # Current data bits
-        self.inbits = 0
-        self.odata = self.syn
-        self.phase = 0              # Interface initial conditions
-        if self.passive:
-            self.dout(0)
-            self.ckout(0)
-        else:
-            self.dout(self.odata & 1)
-            self.ckout(1)
-            self.odata >>= 1        # we've sent that bit
-            self.phase = 1
+        self.rxidx = -1             # Buffer being received. -1: none
+        self.rxcur = self.rxpool    # Pool which owns it
+        self.rxchan = self          # Channel it belongs to
+        self.rxkind = _MSG          # Frame type. -1: discard
+        self.rxpos = 0
+        self.rxlen = 0
+        self.rxstate = _HUNT
+        self.rxtype = 0
+        self.rxcrc = 0
+        self.rxsum = 0
 
     def set_timeout(self, timeout=None):
         if timeout is not None:
@@ -103,103 +627,526 @@ class SynCom(object):
             self.objsched.stop(self.pid)
         self.pid = self.objsched.add_thread(self._run(pin_reset, reset_state))
 
-# Queue an object for tx. Convert to string NOW: snapshot of current
-# object state
-    def send(self, obj):
-        self.lsttx.append(pickle.dumps(obj))
-
-    def send_str(self, string):
-        self.lsttx.append(string)
-
-    def any(self):
-        return len(self.lstrx)
-
-    def _pollfunc(self):  # Don't let a thread hang if it's timed out
-        if self._running:
-            return 1 if len(self.lstrx) else None
-        return 2
-
-    def get(self):
-        if self.any():
-            return pickle.loads(self.lstrx.pop(0))
-
-    def get_str(self):
-        if self.any():
-            return self.lstrx.pop(0)
+    def _crc(self, crc, buf, start, end):
+        table = self.crctable
+        for idx in range(start, end):
+            crc = ((crc << 8) & 0xff00) ^ table[((crc >> 8) ^ buf[idx]) & 0xff]
+        return crc
 
     def _run(self, pin_reset, reset_state):
+        transport = self.transport
         self.init()
         yield
         if pin_reset is not None:
             if self.verbose:
-                print(self.idstr, ' resetting target...')
+                self.output(self.idstr, ' resetting target...')
             pin_reset.value(reset_state)
             yield 0.1
             pin_reset.value(reset_state ^ 1)
             yield 1  # let target settle down
         if self.verbose:
-            print(self.idstr, ' awaiting sync...')
+            self.output(self.idstr, ' awaiting sync...')
         yield
-        while self.indata != self.syn:  # Don't hog CPU while waiting for start
-            yield from self._synchronise()
-        self.lstrx = []  # ? Necessary even though done in ctor. Why?
-#        self.lsttx = [] No need: allow transmissions to be queued before sync
+        yield from transport.connect()
+        self.syncs += 1
+        for chan in self.bypriority:
+            chan._clear()  # Discard anything received before a restart
+#        txpool.clear() No need: allow transmissions to be queued before sync
         if self.verbose:
-            print(self.idstr, ' synchronised')
+            self.output(self.idstr, ' synchronised')
 
-        sendstr = ''                # string for transmission
-        send_idx = None             # character index. None: no current string
-        getstr = ''                 # receive string
-        latency = self.latency      # No of chars to send before yield
+        self.txidx = -1             # Buffer being sent. -1: none
+        send_idx = 0
+        send_len = 0
+        rxchars = self.rxchars
+        chars = 0                   # Throughput measurement
+        tstart = ticks_us()
         try:
             while True:
-                if send_idx is None:
-                    if len(self.lsttx):
-                        sendstr = self.lsttx.pop(0)  # oldest first
+                while transport.writable():  # Pass frames to the transport
+                    if self.txidx < 0:
+                        send_len = self._next_tx()
                         send_idx = 0
-                if send_idx is not None:
-                    if send_idx < len(sendstr):
-                        self.odata = ord(sendstr[send_idx])
-                        send_idx += 1
-                    else:
-                        send_idx = None
-                if send_idx is None:  # send zeros when nothing to send
-                    self.odata = 0
-                if self.passive:
-                    self._get_byte_passive()
-                else:
-                    self._get_byte_active()
-                if self.indata:
-                    getstr = ''.join((getstr, chr(self.indata)))
-                else:                # Got 0:
-                    if len(getstr):  # if there's a string, it's complete
-                        self.lstrx.append(getstr)
-                    getstr = ''
-
-                latency -= 1
-                if latency <= 0:    # yield at intervals of N characters
-                    latency = self.latency
-                    yield
+                        if self.txidx < 0:
+                            break
+                    send_idx += transport.write(self.txsrc.bufs[self.txidx], send_idx, send_len)
+                    if send_idx < send_len:
+                        break
+                    self._sent(send_len)
+                    self._end_tx()
+                transport.hold = self.txidx >= 0
+                transport.pump()
+                while True:
+                    n = transport.readinto(rxchars)
+                    if not n:
+                        break
+                    chars += n
+                    for idx in range(n):
+                        if self.framing == BINARY:
+                            done = self._rx_binary(rxchars[idx])
+                        else:
+                            done = self._rx_text(rxchars[idx])
+                        if done:             # Frame is complete
+                            yield from self._rx_frame()
+                if transport.timedout():
+                    raise SynComError
+                elapsed = ticksdiff(tstart, ticks_us())
+                if elapsed >= 1000000:
+                    self.throughput = chars * 1000000 // elapsed
+                    chars = 0
+                    tstart = ticks_us()
+                yield None if transport.polled else self.await_link
         except SynComError:
+            self.timeouts += 1
             if self.verbose:
-                print('SynCom Timeout')
+                self.output('SynCom Timeout')
         finally:
             self._running = False
+            for chan in self.bypriority:  # Release waiting threads
+                chan.await_obj.set(2)
+                chan.await_chunk.set(2)
+            transport.close()
+            if self.txidx >= 0:     # Return buffers to their pools
+                self._end_tx()
+            if self.rxidx >= 0:
+                self.rxcur.release(self.rxidx)
+                self.rxidx = -1
+
+    def _linkpoll(self):  # Wake the link thread if it has work to do
+        transport = self.transport
+        if transport.any():
+            return 1
+        if transport.writable():
+            if self.txidx >= 0:
+                return 1
+            for chan in self.bypriority:
+                if chan._txready() or (self.flow and chan.regrant):
+                    return 1
+        return None
+
+    def _next_tx(self):  # Start sending the next frame. Return its length.
+        if self.flow:               # Credit first: the peer may be waiting
+            for chan in self.bypriority:
+                if chan.regrant:
+                    chan.regrant = False
+                    chan.grant[2] = chan.txsent  # Frames already passed
+                    chan.grant[3] = chan.chunksent  # to the transport
+                    kind = _PROBE if chan.probe else _CREDIT
+                    chan.probe = False
+                    pool = self.ctlpool
+                    self.txidx = chan._frame(chan.grant, kind, pool)
+                    self.txsrc = pool
+                    return pool.lens[self.txidx]
+        for chan in self.bypriority:  # Highest priority first
+            txidx = chan._next_frame()
+            if txidx >= 0:
+                self.txidx = txidx
+                self.txsrc = chan.txpool
+                return chan.txpool.lens[txidx]
+        return 0
+
+    def _sent(self, length):  # Frame has been passed to the transport
+        if self.txsrc is self.ctlpool:
+            self.txcredits += 1     # Not data: keep out of the statistics
+            return
+        lat = ticksdiff(self.txsrc.stamps[self.txidx], ticks_us())
+        if self.txframes:
+            self.lat_min = min(self.lat_min, lat)
+            self.lat_avg = (self.lat_avg * 7 + lat) >> 3
+        else:
+            self.lat_min = self.lat_avg = lat
+        if lat > self.lat_max:
+            self.lat_max = lat
+        self.txframes += 1
+        self.txbytes += length - self.txover
+
+    def _end_tx(self):
+        self.txsrc.release(self.txidx)
+        self.txidx = -1
+
+    def _rx_frame(self):  # Queue a completed frame. May stall the link.
+        rxidx = self.rxidx
+        chan = self.rxchan
+        rxpool = self.rxcur
+        rxq = rxpool.queue
+        if self.rxkind >= _CREDIT:
+            self.rxcredits += 1
+            chan._credit(rxpool.bufs[rxidx], self.rxkind == _PROBE)
+            rxpool.release(rxidx)
+            self.rxidx = -1
+            return
+        self.rxframes += 1
+        self.rxbytes += self.rxlen
+        if self.rxlen > self.bufsize or self.rxkind < 0:
+            chan.rxdropped += 1  # Overlong or unknown frame
+            rxpool.release(rxidx)
+        elif self.rxkind != _MSG:  # Stream data is never dropped
+            chan.chunkcount = (chan.chunkcount + 1) & 0xff
+            while rxq.full():
+                yield
+            rxpool.lens[rxidx] = self.rxlen
+            rxq.put(rxidx)
+            chan.await_chunk.set()  # Wake consumer
+        else:
+            chan.rxcount = (chan.rxcount + 1) & 0xff
+            if rxq.full():
+                if chan.policy == BLOCK:  # Stall the link until
+                    while rxq.full():     # the consumer catches up
+                        yield
+                else:
+                    chan.rxdropped += 1
+                    chan._free(0)  # Dropped frame uses no slot
+                    if chan.policy == DROP_NEWEST:
+                        rxpool.release(rxidx)
+                        rxidx = -1
+                    else:
+                        rxpool.release(rxq.get())
+            if rxidx >= 0:
+                rxpool.lens[rxidx] = self.rxlen
+                rxq.put(rxidx)
+                if len(rxq) > chan.rxpeak:
+                    chan.rxpeak = len(rxq)
+                chan.await_obj.set()
+        self.rxidx = -1
+
+    def _rx_text(self, data):  # Store a character. Return True if frame complete.
+        if data:
+            if self.rxidx < 0:
+                self.rxidx = self.rxpool.alloc()
+                self.rxpos = 0
+            if self.rxpos < self.bufsize:
+                self.rxpool.bufs[self.rxidx][self.rxpos] = data
+            self.rxpos += 1  # Overlong frame is discarded when complete
+            return False
+        if self.rxidx >= 0:  # Got 0: frame is complete
+            self.rxlen = self.rxpos
+            return True
+        return False
+
+    def _rx_binary(self, data):  # Store a byte. Return True if frame complete.
+        state = self.rxstate
+        if state == _HUNT:
+            if data == _SOF:
+                self.rxstate = _TYPE
+                self.rxcrc = 0xffff
+            return False
+        if state == _DATA:
+            if self.rxpos < self.bufsize:
+                self.rxcur.bufs[self.rxidx][self.rxpos] = data
+            self.rxpos += 1
+            if self.crc:
+                table = self.crctable
+                crc = self.rxcrc
+                self.rxcrc = ((crc << 8) & 0xff00) ^ table[((crc >> 8) ^ data) & 0xff]
+            if self.rxpos < self.rxlen:
+                return False
+        elif state == _CRC0:
+            self.rxsum = data   # Received CRC LSB
+            self.rxstate = _CRC1
+            return False
+        elif state == _CRC1:
+            self.rxstate = _HUNT
+            if (data << 8) | self.rxsum != self.rxcrc:
+                self.crcerrors += 1
+                self.rxcur.release(self.rxidx)
+                self.rxidx = -1
+                if self.flow:   # Frame may have been a credit: grant again
+                    for chan in self.bypriority:  # and allow a new probe
+                        chan.regrant = True
+                        chan.probed = False
+                return False
+            return True
+        else:               # Header
+            if self.crc:
+                table = self.crctable
+                crc = self.rxcrc
+                self.rxcrc = ((crc << 8) & 0xff00) ^ table[((crc >> 8) ^ data) & 0xff]
+            if state == _TYPE:
+                self.rxtype = data
+                self.rxstate = _LEN0
+                return False
+            if state == _LEN0:
+                self.rxlen = data
+                self.rxstate = _LEN1
+                return False
+            self.rxlen |= data << 8  # _LEN1: start of payload
+            chan = self.chans[self.rxtype >> 4]
+            kind = self.rxtype & 0x0f
+            if chan is None:    # Unknown channel: discard when complete
+                chan = self
+                kind = -1
+            pool = chan.rxpool
+            if kind == _CHUNK or kind == _END:
+                if chan.chunkpool is None:
+                    kind = -1
+                else:
+                    pool = chan.chunkpool
+            elif kind == _CREDIT or kind == _PROBE:
+                if self.flow and self.rxlen == 4:
+                    pool = self.ctlpool
+                else:
+                    kind = -1
+            elif kind != _MSG:
+                kind = -1
+            if self.rxlen > self.bufsize:  # Corrupt length: don't swallow
+                chan.rxdropped += 1        # the frames which follow
+                if kind == _MSG:           # Return its credit
+                    chan.rxcount = (chan.rxcount + 1) & 0xff
+                    chan._free(0)
+                elif kind == _CHUNK or kind == _END:
+                    chan.chunkcount = (chan.chunkcount + 1) & 0xff
+                    chan._free(1)
+                self.rxstate = _HUNT
+                return False
+            self.rxchan = chan
+            self.rxkind = kind
+            self.rxcur = pool
+            self.rxidx = pool.alloc()
+            self.rxpos = 0
+            if self.rxlen:
+                self.rxstate = _DATA
+                return False
+        if self.crc:        # End of payload
+            self.rxstate = _CRC0
+            return False
+        self.rxstate = _HUNT
+        return True
+
+# The four wire bit-banged transport. Characters are exchanged via rings: in
+# polled mode pump exchanges up to latency characters, blocking while it waits
+# for the peer's clock. In interrupt mode each edge on ckin runs _isr which
+# exchanges one bit and toggles ckout, so pump does nothing and the link
+# thread only runs when there are characters to process. The link is stalled
+# by not toggling ckout if the rx ring is full or the tx ring runs dry part
+# way through a frame (hold). Between frames zeros are sent.
+class BitBang(object):
+    syn = 0x9d
+
+    def __init__(self, passive, ckin, ckout, din, dout, latency=5, max_block=0,
+                 irq=False, ringsize=32):
+        self.passive = passive
+        self.ckin = ckin            # Interface pins
+        self.ckout = ckout
+        self.din = din
+        self.dout = dout
+        self.latency = max(latency, 1)  # No. of bytes between scheduler yield
+        self.minlatency = self.latency
+        self.max_block = max_block  # Adaptive latency: max us between yields
+        self.char_us = 0            # Measured time per character
+        self.irq = irq              # Use pin interrupts
+        self.polled = not irq
+        self.hold = False
+        self.timeout = 0
+        if ringsize < 2 or ringsize & (ringsize - 1):
+            raise ValueError('ringsize must be a power of 2')
+        self.rxring = bytearray(ringsize)  # Written by pump or ISR
+        self.txring = bytearray(ringsize)  # Read by pump or ISR
+        self.mask = ringsize - 1
+        self.rxri = self.rxwi = 0   # Ring indices
+        self.txri = self.txwi = 0
+        self.stalled = False
+        self._zero()
+        if irq:
+            if disable_irq is None:
+                raise ValueError('irq requires the machine module')
+            self.irqtrigger = ckin.IRQ_RISING | ckin.IRQ_FALLING
+
+    def bind(self, link):
+        self.link = link
+        self.bits = 8 if link.framing == BINARY else _BITS_PER_CH
+
+    def _zero(self):
+        self.blocked_us = 0         # Waiting for the peer's clock in _get_bit
+        self.blocked_ms = 0
+        self.gap_max = 0            # Longest time between pumps (us)
+        self.stalls = 0             # Interrupt mode: link stalled by this end
+
+# Time blocked shows link saturation or a slow peer. gap_max shows how long
+# other threads delay the link thread: scheduler starvation.
+    def stats(self, d, reset):
+        d['blocked_ms'] = self.blocked_ms + self.blocked_us // 1000
+        d['gap_max'] = self.gap_max
+        d['stalls'] = self.stalls
+        if reset:
+            self._zero()
+
+    def connect(self):
+        self.indata = 0             # Current data bits
+        self.odata = self.syn
+        self.phase = 0              # Interface initial conditions
+        self.rxri = self.rxwi = 0
+        self.txri = self.txwi = 0
+        self.stalled = False
+        if self.passive:
             self.dout(0)
             self.ckout(0)
+        else:
+            self.dout(self.odata & 1)
+            self.ckout(1)
+            self.odata >>= 1        # we've sent that bit
+            self.phase = 1
+        while self.indata != self.syn:  # Don't hog CPU while waiting for start
+            yield from self._synchronise()
+        self.ibits = 0              # Bits being sent and received
+        self.idata = 0
+        self.itx = 0                # Bit counts
+        self.irx = self.bits - 1 if self.passive else 0  # Passive: MSB outstanding
+        self.tedge = ticks_us()     # Time of last edge
+        self.tyield = self.tedge    # End of last burst
+        if self.irq:
+            self.ckin.irq(handler=self._isr, trigger=self.irqtrigger)
+            self._kick()            # In case an edge was missed
+
+    def close(self):
+        if self.irq:
+            self.ckin.irq(handler=None)
+        self.dout(0)
+        self.ckout(0)
+
+    def write(self, buf, start, end):
+        mask = self.mask
+        ring = self.txring
+        idx = start
+        while idx < end and (self.txwi + 1) & mask != self.txri:
+            ring[self.txwi] = buf[idx]
+            self.txwi = (self.txwi + 1) & mask
+            idx += 1
+        return idx - start
+
+    def readinto(self, buf):
+        mask = self.mask
+        ring = self.rxring
+        n = 0
+        size = len(buf)
+        while n < size and self.rxri != self.rxwi:
+            buf[n] = ring[self.rxri]
+            self.rxri = (self.rxri + 1) & mask
+            n += 1
+        return n
+
+    def any(self):
+        return self.rxri != self.rxwi or self.stalled or self.timedout()
+
+    def writable(self):  # In irq mode wake the link thread when ring is low
+        count = (self.txwi - self.txri) & self.mask
+        return count < self.mask >> 1 if self.irq else count < self.mask
+
+    def timedout(self):
+        timeout = self.link.timeout
+        return timeout and ticksdiff(self.tedge, ticks_us()) > timeout and not self.stalled
+
+    def pump(self):
+        if self.irq:
+            if self.stalled:
+                self._kick()
+            return
+        self.timeout = self.link.timeout
+        tstart = ticks_us()
+        gap_us = ticksdiff(self.tyield, tstart)
+        if gap_us > self.gap_max:
+            self.gap_max = gap_us
+        mask = self.mask
+        n = 0
+        while n < self.latency:
+            if (self.rxwi + 1) & mask == self.rxri:
+                break               # rx ring full
+            if self.txri != self.txwi:
+                self.odata = self.txring[self.txri]
+                self.txri = (self.txri + 1) & mask
+            elif self.hold:
+                break               # Wait for rest of frame
+            else:
+                self.odata = 0      # send zeros when nothing to send
+            if self.passive:
+                self._get_byte_passive()
+            else:
+                self._get_byte_active()
+            self.rxring[self.rxwi] = self.indata
+            self.rxwi = (self.rxwi + 1) & mask
+            n += 1
+        self.tyield = ticks_us()
+        self.tedge = self.tyield
+        if self.blocked_us >= 1000:  # Keep it a small int
+            self.blocked_ms += self.blocked_us // 1000
+            self.blocked_us %= 1000
+        if self.max_block and n:
+            self._adapt(ticksdiff(tstart, self.tyield), n, gap_us)
+
+# Adaptive latency. Set the number of characters per burst so that a burst
+# lasts at most max_block us. If other threads ran for only a short time while
+# the link was yielded the system is idle and the burst is increased to use
+# the spare CPU. If they ran for longer than max_block it is reduced towards
+# the latency constructor arg so that busy threads get a larger share.
+    def _adapt(self, burst_us, n, gap_us):
+        char_us = max(burst_us // n, 1)
+        if self.char_us:            # Smooth out variations
+            char_us = (self.char_us * 3 + char_us) >> 2
+        self.char_us = char_us
+        n = self.latency
+        max_block = self.max_block
+        if gap_us < max_block >> 2:
+            n += (n >> 2) + 1
+        elif gap_us >= max_block:
+            n = max(n - (n >> 2), self.minlatency)
+        self.latency = max(min(n, max_block // char_us), 1)
+
+    def _kick(self):  # Run the ISR if the link is waiting on this end
+        state = disable_irq()
+        self.stalled = False
+        self._isr(None)
+        enable_irq(state)
+
+    def _isr(self, _):
+        if self.ckin() == self.phase ^ self.passive ^ 1:
+            return                  # Not our turn
+        bits = self.bits
+        mask = self.mask
+        if self.irx == bits - 1 and (self.rxwi + 1) & mask == self.rxri:
+            self.stalled = True     # rx ring full
+            self.stalls += 1
+            return
+        if self.itx == 0:           # Start of a character
+            if self.txri != self.txwi:
+                self.ibits = self.txring[self.txri]
+                self.txri = (self.txri + 1) & mask
+            elif self.hold:
+                self.stalled = True  # Underrun part way through a frame
+                self.stalls += 1
+                return
+            else:
+                self.ibits = 0
+        self.tedge = ticks_us()
+        idata = (self.idata | (self.din() << bits)) >> 1
+        self.irx += 1
+        if self.irx == bits:
+            self.rxring[self.rxwi] = idata
+            self.rxwi = (self.rxwi + 1) & mask
+            self.irx = 0
+            idata = 0
+        self.idata = idata
+        obyte = self.ibits
+        self.dout(obyte & 1)
+        self.ibits = obyte >> 1
+        self.itx += 1
+        if self.itx == bits:
+            self.itx = 0
+        self.phase ^= 1
+        self.ckout(self.phase)
 
     def _get_byte_active(self):
         inbits = 0
-        for _ in range(_BITS_PER_CH):
-            inbits = self._get_bit(inbits)  # LSB first
+        bits = self.bits
+        for _ in range(bits):
+            inbits = self._get_bit(inbits, bits)  # LSB first
         self.indata = inbits
 
     def _get_byte_passive(self):
-        self.indata = self._get_bit(self.inbits)  # MSB is outstanding
+        bits = self.bits
+        self.indata = self._get_bit(self.idata, bits)  # MSB is outstanding
         inbits = 0
-        for _ in range(_BITS_PER_CH - 1):
-            inbits = self._get_bit(inbits)
-        self.inbits = inbits
+        for _ in range(bits - 1):
+            inbits = self._get_bit(inbits, bits)
+        self.idata = inbits
 
     def _synchronise(self):         # wait for clock
         while self.ckin() == self.phase ^ self.passive ^ 1:
@@ -211,15 +1158,52 @@ class SynCom(object):
         self.phase ^= 1
         self.ckout(self.phase)      # set clock
 
-    def _get_bit(self, dest):
-        t = ticks_us()
-        while self.ckin() == self.phase ^ self.passive ^ 1:
-            if self.timeout and ticksdiff(t, ticks_us()) > self.timeout:
-                raise SynComError
-        dest = (dest | (self.din() << _BITS_PER_CH)) >> 1
+    def _get_bit(self, dest, bits):
+        if self.ckin() == self.phase ^ self.passive ^ 1:  # Wait for peer
+            t = ticks_us()
+            while self.ckin() == self.phase ^ self.passive ^ 1:
+                if self.timeout and ticksdiff(t, ticks_us()) > self.timeout:
+                    raise SynComError
+            self.blocked_us += ticksdiff(t, ticks_us())
+        dest = (dest | (self.din() << bits)) >> 1
         obyte = self.odata
         self.dout(obyte & 1)
         self.odata = obyte >> 1
         self.phase ^= 1
         self.ckout(self.phase)
         return dest
+
+# The original interface: a Link over the bit-banged transport.
+class SynCom(Link):
+    def __init__(self, objsched, passive, ckin, ckout, din, dout, latency=5,
+                 verbose=True, txdepth=8, rxdepth=8, policy=DROP_OLDEST,
+                 bufsize=128, framing=TEXT, crc=False, codec=None,
+                 streamdepth=2, max_block=0, irq=False, ringsize=32,
+                 flow=False):
+        transport = BitBang(passive, ckin, ckout, din, dout, latency,
+                            max_block, irq, ringsize)
+        super().__init__(objsched, transport, verbose, txdepth, rxdepth, policy,
+                         bufsize, framing, crc, codec, streamdepth, flow)
+
+    @property
+    def latency(self):
+        return self.transport.latency
+
+    @property
+    def char_us(self):
+        return self.transport.char_us
+
+# Where the native code emitter is available the bit loop is replaced by the
+# compiled version in syncomnative.py. The bytecode versions are retained for
+# comparison by bench.bitloop().
+bytecode = None
+try:
+    import syncomnative
+except (ImportError, SyntaxError):
+    pass
+else:
+    bytecode = (BitBang._get_bit, BitBang._get_byte_active,
+                BitBang._get_byte_passive)
+    BitBang._get_bit = syncomnative.get_bit
+    BitBang._get_byte_active = syncomnative.get_byte_active
+    BitBang._get_byte_passive = syncomnative.get_byte_passive
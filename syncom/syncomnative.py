@@ -0,0 +1,68 @@
+# syncomnative.py Native code versions of the SynCom bit loop.
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Peter Hinch
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Imported by syncom.py, which replaces the BitBang methods which transfer
+# bits with these. If the port lacks the native code emitter compiling this
+# module raises SyntaxError and the bytecode versions are used. The logic is
+# that of the methods in syncom.py.
+
+import micropython
+from utime import ticks_us
+from syncom import SynComError, ticksdiff
+
+@micropython.native
+def get_bit(self, dest, bits):  # BitBang._get_bit
+    ckin = self.ckin
+    wait = self.phase ^ self.passive ^ 1
+    if ckin() == wait:              # Wait for peer
+        t = ticks_us()
+        timeout = self.timeout
+        while ckin() == wait:
+            if timeout and ticksdiff(t, ticks_us()) > timeout:
+                raise SynComError
+        self.blocked_us += ticksdiff(t, ticks_us())
+    dest = (dest | (self.din() << bits)) >> 1
+    obyte = self.odata
+    self.dout(obyte & 1)
+    self.odata = obyte >> 1
+    self.phase ^= 1
+    self.ckout(self.phase)
+    return dest
+
+@micropython.native
+def get_byte_active(self):  # BitBang._get_byte_active
+    inbits = 0
+    bits = self.bits
+    for _ in range(bits):
+        inbits = get_bit(self, inbits, bits)  # LSB first
+    self.indata = inbits
+
+@micropython.native
+def get_byte_passive(self):  # BitBang._get_byte_passive
+    bits = self.bits
+    self.indata = get_bit(self, self.idata, bits)  # MSB is outstanding
+    inbits = 0
+    for _ in range(bits - 1):
+        inbits = get_bit(self, inbits, bits)
+    self.idata = inbits
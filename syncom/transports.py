@@ -0,0 +1,220 @@
+# transports.py Alternative transports for the SynCom protocol layer (Link).
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Peter Hinch
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Each class implements the transport interface documented above class Link
+# in syncom.py. The bit-banged transport (BitBang) is in syncom.py.
+
+from utime import ticks_us
+from syncom import ticksdiff
+
+# Hardware UART. Whole buffers are passed to the UART driver which handles
+# timing, so the link thread only runs when characters have been received or
+# there is data to send. There is no idle fill so a dead peer cannot be
+# detected: timeouts are not supported.
+class UARTTransport(object):
+    def __init__(self, uart, passive=False):
+        self.uart = uart
+        self.passive = passive
+        self.polled = False
+        self.hold = False
+
+    def bind(self, link):
+        self.link = link
+
+    def connect(self):
+        yield
+
+    def close(self):
+        pass
+
+    def pump(self):
+        pass
+
+    def write(self, buf, start, end):
+        n = self.uart.write(memoryview(buf)[start:end])
+        return n if n else 0        # None on timeout
+
+    def readinto(self, buf):
+        n = self.uart.any()
+        if n:                       # Ask only for what is waiting: a UART with
+            n = self.uart.readinto(buf, min(n, len(buf)))  # a timeout would block
+            return n if n else 0
+        return 0
+
+    def any(self):
+        return self.uart.any()
+
+    def writable(self):
+        return True
+
+    def timedout(self):
+        return False
+
+# SPI. Data is exchanged in blocks of blocksize bytes, zero padded between
+# frames. The initiator is the SPI controller: it must clock the bus to
+# receive so it transfers a block on every pass of the link thread. cs is an
+# optional chip select Pin (active low). The passive end uses a Pyboard SPI
+# instance in SLAVE mode: send_recv blocks for up to wait ms for the
+# controller so the scheduler is blocked for that time if the controller is
+# busy. Its timeout detects a controller which has stopped clocking.
+class SPITransport(object):
+    def __init__(self, spi, passive=False, cs=None, blocksize=32, wait=10):
+        self.spi = spi
+        self.passive = passive
+        self.cs = cs
+        self.wait = wait
+        self.polled = True
+        self.hold = False
+        self.txbuf = bytearray(blocksize)
+        self.rxbuf = bytearray(blocksize)
+        self.txn = 0                # Bytes waiting in txbuf
+        self.rxpos = 0              # Bytes of rxbuf not yet read
+        self.rxn = 0
+        self.tlast = 0              # Time of last transfer
+        if cs is not None:
+            cs(1)
+
+    def bind(self, link):
+        self.link = link
+
+    def connect(self):
+        self.txn = 0
+        self.rxpos = self.rxn = 0
+        self.tlast = ticks_us()
+        yield
+
+    def close(self):
+        pass
+
+    def pump(self):
+        if self.rxpos < self.rxn:
+            return                  # Link has not read the last block
+        txbuf = self.txbuf
+        for idx in range(self.txn, len(txbuf)):
+            txbuf[idx] = 0          # Idle
+        if self.passive:
+            try:
+                self.spi.send_recv(txbuf, self.rxbuf, timeout=self.wait)
+            except OSError:         # Controller did not clock the bus
+                return
+        else:
+            if self.cs is not None:
+                self.cs(0)
+            self.spi.write_readinto(txbuf, self.rxbuf)
+            if self.cs is not None:
+                self.cs(1)
+        self.txn = 0
+        self.rxpos = 0
+        self.rxn = len(self.rxbuf)
+        self.tlast = ticks_us()
+
+    def write(self, buf, start, end):
+        txbuf = self.txbuf
+        n = min(end - start, len(txbuf) - self.txn)
+        for idx in range(n):
+            txbuf[self.txn + idx] = buf[start + idx]
+        self.txn += n
+        return n
+
+    def readinto(self, buf):
+        n = min(len(buf), self.rxn - self.rxpos)
+        rxbuf = self.rxbuf
+        for idx in range(n):
+            buf[idx] = rxbuf[self.rxpos + idx]
+        self.rxpos += n
+        return n
+
+    def any(self):
+        return self.rxpos < self.rxn
+
+    def writable(self):
+        return self.txn < len(self.txbuf)
+
+    def timedout(self):
+        timeout = self.link.timeout
+        return timeout and ticksdiff(self.tlast, ticks_us()) > timeout
+
+# In-memory transport for testing on a single device or a host. loopback()
+# returns a connected pair: bytes written to one are read from the other.
+# The two links may run under the same or different schedulers. Each ring
+# has one writer and one reader so schedulers may run in separate threads.
+class Loopback(object):
+    def __init__(self, size=256, passive=False):
+        self.ring = bytearray(size)  # Received bytes. One slot is unused.
+        self.size = size
+        self.ri = 0
+        self.wi = 0
+        self.peer = None
+        self.passive = passive
+        self.polled = False
+        self.hold = False
+
+    def bind(self, link):
+        self.link = link
+
+    def connect(self):
+        yield
+
+    def close(self):
+        pass
+
+    def pump(self):
+        pass
+
+    def write(self, buf, start, end):
+        peer = self.peer
+        n = min(end - start, peer.size - 1 - peer.any())
+        ring = peer.ring
+        wi = peer.wi
+        for idx in range(start, start + n):
+            ring[wi] = buf[idx]
+            wi = (wi + 1) % peer.size
+        peer.wi = wi
+        return n
+
+    def readinto(self, buf):
+        n = min(len(buf), self.any())
+        ring = self.ring
+        ri = self.ri
+        for idx in range(n):
+            buf[idx] = ring[ri]
+            ri = (ri + 1) % self.size
+        self.ri = ri
+        return n
+
+    def any(self):  # No. of bytes waiting
+        return (self.wi - self.ri) % self.size
+
+    def writable(self):
+        return self.peer.any() < self.peer.size - 1
+
+    def timedout(self):
+        return False
+
+def loopback(size=256):
+    a = Loopback(size)
+    b = Loopback(size, True)
+    a.peer = b
+    b.peer = a
+    return a, b
@@ -0,0 +1,76 @@
+# trace2json.py Convert a usched trace dump to Chrome trace JSON
+# Author: Peter Hinch
+# Copyright Peter Hinch 2016 Released under the MIT license
+
+# Runs on a PC under CPython 3. The output may be loaded into chrome://tracing or https://ui.perfetto.dev
+# Usage: python3 trace2json.py trace.bin trace.json
+# Each thread appears as a track named by its pid. Each run of a thread is a slice labelled with the reason it was
+# scheduled and the way it yielded. Interrupts are shown as instant events and garbage collection as slices on
+# the "scheduler" track.
+
+import json
+import struct
+import sys
+
+TIMERPERIOD = 0x3fffffff                        # As usched.py
+TR_START, TR_RESUME, TR_YIELD, TR_END, TR_IRQ, TR_GC = range(6)
+REASONS = ('roundrobin', 'interrupt', 'poll', 'time')
+YIELDS = ('roundrobin', 'delay', 'Poller', 'Pinblock', 'Event')
+
+def read(filename):                             # Return a list of (time, pid, event, arg). Time is in us
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'UTR1':
+        raise ValueError('Not a usched trace dump')
+    n = struct.unpack_from('<I', data, 4)[0]
+    records = []
+    t = 0
+    last = None
+    for tim, info in struct.iter_unpack('<II', data[8:8 + 8 * n]):
+        if last is not None:
+            t += (tim - last) & TIMERPERIOD     # Timer wraps
+        last = tim
+        records.append((t, info >> 8, (info >> 4) & 0x0f, info & 0x0f))
+    return records
+
+def convert(records):
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 0, 'args': {'name': 'scheduler'}}]
+    named = set()
+    running = {}                                # pid: reason for current slice
+    for t, pid, event, arg in records:
+        if event in (TR_START, TR_RESUME) and pid not in named:
+            named.add(pid)
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': pid,
+                           'args': {'name': 'thread {}'.format(pid)}})
+        if event == TR_START:
+            events.append({'name': 'start', 'ph': 'i', 's': 't', 'ts': t, 'pid': 0, 'tid': pid})
+        elif event == TR_RESUME:
+            running[pid] = REASONS[arg] if arg < len(REASONS) else str(arg)
+            events.append({'name': 'run', 'ph': 'B', 'ts': t, 'pid': 0, 'tid': pid,
+                           'args': {'reason': running[pid]}})
+        elif event == TR_YIELD:
+            if pid in running:
+                del running[pid]
+                events.append({'name': 'run', 'ph': 'E', 'ts': t, 'pid': 0, 'tid': pid,
+                               'args': {'yielded': YIELDS[arg] if arg < len(YIELDS) else str(arg)}})
+        elif event == TR_END:
+            if pid in running:                  # Ended while running
+                del running[pid]
+                events.append({'name': 'run', 'ph': 'E', 'ts': t, 'pid': 0, 'tid': pid})
+            events.append({'name': 'end', 'ph': 'i', 's': 't', 'ts': t, 'pid': 0, 'tid': pid})
+        elif event == TR_IRQ:
+            events.append({'name': 'irq {}'.format(pid), 'ph': 'i', 's': 'p', 'ts': t, 'pid': 0, 'tid': 0})
+        elif event == TR_GC:
+            events.append({'name': 'gc', 'ph': 'E' if arg else 'B', 'ts': t, 'pid': 0, 'tid': 0})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def main(argv):
+    if len(argv) != 3:
+        print('Usage: python3 trace2json.py trace.bin trace.json')
+        return 1
+    with open(argv[2], 'w') as f:
+        json.dump(convert(read(argv[1])), f)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,5 +1,12 @@
 # Lightweight threading library for the micropython board.
 # Author: Peter Hinch
+# V1.16 IrqRing passes data from interrupt handlers to threads.
+# V1.15 Timeout spin option for precise wakeups.
+# V1.14 Clock class: ticks_ms, ticks_us or ticks_cpu clock sources.
+# V1.13 Uses native code for hot paths where available.
+# V1.12 Sched.current holds the pid of the running thread for profiler.py.
+# V1.11 Optional binary trace of scheduler events.
+# V1.10 Event class: threads waiting on an Event are not polled.
 # V1.09 const now in micropython. Fix for context managers in threads which are stopped.
 # V1.08 Sets gc threshold in low priority thread. Checks add_thread() reentrancy.
 # V1.07 Thread status method added.
@@ -8,8 +15,13 @@
 # Copyright Peter Hinch 2016 Released under the MIT license
 
 import gc
-from utime import ticks_us
+from array import array
+from utime import ticks_us, ticks_ms
 from sys import platform
+try:
+    from utime import ticks_cpu
+except ImportError:
+    ticks_cpu = None
 try:
     from micropython import const
 except ImportError:
@@ -47,12 +59,94 @@ def seconds(S):                                 # Utility functions to convert t
 def millisecs(mS):
     return int(1000*mS)
 
+# CLOCK SOURCES
+# The functions above use ticks_us. A Clock provides the same operations on a chosen source: ticks_ms for long
+# waits (up to 6.2 days) and ticks_cpu for measuring short intervals. All MicroPython ticks functions have a period
+# which is a multiple of TIMERPERIOD + 1 so the same masking handles wrap. A CPU clock's frequency is read from
+# machine.freq() where possible, otherwise it must be passed; if unknown the clock measures ticks but cannot be
+# used for delays. Clock values are in ticks of the source: late_us() converts to uS.
+
+CLOCK_MS = const(0)
+CLOCK_US = const(1)
+CLOCK_CPU = const(2)
+
+def _cpufreq():
+    try:
+        import machine
+        freq = machine.freq()
+    except (ImportError, AttributeError):
+        return None
+    return freq[0] if isinstance(freq, tuple) else freq
+
+class Clock(object):
+    def __init__(self, source=CLOCK_US, freq=None):
+        self.mul = 1                            # Conversion of ticks to uS
+        self.div = 1
+        if source == CLOCK_MS:
+            self.ticks = ticks_ms
+            self.freq = 1000
+            self.mul = 1000
+        elif source == CLOCK_US:
+            self.ticks = ticks_us
+            self.freq = 1000000
+        elif source == CLOCK_CPU:
+            if ticks_cpu is None:
+                raise ValueError('ticks_cpu is not available')
+            self.ticks = ticks_cpu
+            self.freq = _cpufreq() if freq is None else freq    # Ticks per second or None if unknown
+            if self.freq is not None:
+                self.div = max(self.freq // 1000000, 1)
+        else:
+            raise ValueError('Invalid clock source')
+        self.maxsecs = MAXTIME // self.freq if self.freq else 0  # Whole seconds
+
+    def now(self):
+        return self.ticks()
+
+    def when(self, ticks):                      # Expected value of counter in a given no. of ticks
+        if ticks >= MAXTIME:
+            raise TimerException()
+        return (self.ticks() + ticks) & TIMERPERIOD
+
+    def after(self, trigtime):                  # Ticks after the specified value or zero
+        res = ((self.ticks() - trigtime) & TIMERPERIOD)
+        if res >= MAXTIME:
+            res = 0
+        return res
+
+    def until(self, trigtime):
+        return ((trigtime - self.ticks()) & TIMERPERIOD)
+
+    def elapsed(self, start):                   # Ticks since start: for instrumentation
+        return ((self.ticks() - start) & TIMERPERIOD)
+
+    def diff(self, start, end):
+        return ((end - start) & TIMERPERIOD)
+
+    def ticks_of(self, secs):
+        if not self.freq:
+            raise ValueError('Clock frequency is unknown')
+        return int(self.freq * secs)
+
+    def late_us(self, trigtime):                # uS after the specified value or zero. Nonzero if it has passed.
+        res = self.after(trigtime)
+        if res:
+            res = max(min(res * self.mul // self.div, MAXTIME), 1)
+        return res
+
+clock_ms = Clock(CLOCK_MS)
+clock_us = Clock(CLOCK_US)
+
 # WAITFOR CLASS
 # This is a base class. User threads should use classes derived from this.
 
 class Waitfor(object):
     def __init__(self):
-        self.uS = 0                             # Current value of timeout in uS
+        self.uS = 0                             # Current value of timeout in uS (in ticks if clock is set)
+        self.clock = None                       # Clock for timeout. None: ticks_us
+        self.spin = 0                           # uS before the timeout at which to busy-wait
+        self.ring = None                        # Optional IrqRing: receives a value on each interrupt
+        self.capture = None                     # Function returning the value. None: ticks_us()
         self.timeout = microsWhen(0)            # End value of microsecond counter when TO has elapsed
         self.forever = False                    # "infinite" time delay flag
         self.irq = None                         # Interrupt vector no
@@ -78,26 +172,46 @@ class Waitfor(object):
         if not self.forever:                    # Check for timeout
             if self.roundrobin:
                 return (0,0,0)                  # Priority value of round robin thread
-            res = after(self.timeout)           # uS after, or zero if not yet timed out in which case we return None
+            if self.clock is None:              # uS after, or zero if not yet timed out in which case we return None
+                res = after(self.timeout)
+            else:
+                res = self.clock.late_us(self.timeout)
             if res:                             # Note: can never return (0,0,0) here!
                 return (0, 0, res)              # Nonzero means it's timed out
         return None                             # Not ready for execution
 
+    def _spinwait(self):                        # Busy-wait for the timeout. Called by the scheduler.
+        while True:
+            res = after(self.timeout)
+            if res:
+                return (0, 0, res)
+
     def _ussetdelay(self, uS=None):             # Reset the timer by default to its last value
         if uS:                                  # If a value was passed, update it
             self.uS = uS
-        self.timeout = microsWhen(self.uS)      # Target timer value
+        if self.clock is None:
+            self.timeout = microsWhen(self.uS)  # Target timer value
+        else:
+            self.timeout = self.clock.when(self.uS)
         return self
 
-    def setdelay(self, secs=None):              # Method used by derived classes to alter timer values
+    def setdelay(self, secs=None, clock=None):  # Method used by derived classes to alter timer values
+        if clock is not None:                   # Optional Clock instance
+            self.clock = clock
         if secs is None:                        # Set to infinity
             self.forever = True
             return self
         else:                                   # Update saved delay and calculate a new end time
-            if secs <= 0 or secs > MAXSECS:
+            if self.clock is None:
+                if secs <= 0 or secs > MAXSECS:
+                    raise ValueError('Invalid time delay')
+                self.forever = False
+                return self._ussetdelay(seconds(secs))
+            ticks = self.clock.ticks_of(secs)
+            if ticks <= 0 or ticks >= MAXTIME:
                 raise ValueError('Invalid time delay')
             self.forever = False
-            return self._ussetdelay(seconds(secs))
+            return self._ussetdelay(ticks)
 
     def __call__(self):                         # Convenience function allows user to yield an updated
         if self.uS:                             # waitfor object
@@ -105,9 +219,13 @@ class Waitfor(object):
         return self
 
     def intcallback(self, irqno):               # Runs in interrupt's context.
+        if self.ring is not None:               # Sample first: the custom callback would delay it
+            self.ring.put(ticks_us() if self.capture is None else self.capture())
         if self.customcallback:
             self.customcallback(irqno)
         self.interruptcount += 1                # Increments count to enable trigger to operate
+        if _trace is not None:
+            _trace.record(TR_IRQ, irqno)
 
 class Roundrobin(Waitfor):                      # Compatibility only. Use a plain yield
     def __init__(self):
@@ -115,30 +233,100 @@ class Roundrobin(Waitfor):                      # Compatibility only. Use a plai
         self.roundrobin = True
 
 # Intended for device drivers
+# If spin is nonzero, once the timeout is due within spin uS the scheduler only runs threads with pending interrupts,
+# poll results or events: delays, roundrobin threads and garbage collection wait. So spin should exceed the longest
+# time any thread runs between yields. When nothing else can run and the timeout is due within SPINTIME uS the
+# scheduler busy-waits until it expires.
 class Timeout(Waitfor):
-    def __init__(self, tim):
+    def __init__(self, tim, clock=None, spin=0):
         super().__init__()
-        self.setdelay(tim)
+        if spin and clock is not None:
+            raise ValueError('spin requires the default clock')
+        self.spin = spin
+        self.setdelay(tim, clock)
 
 # yield from wait
 def wait(secs):
     if secs <=0 :
         raise TimerException()
-    count, tstart = divmod(secs, MAXSECS)
+    clock = None if secs <= MAXSECS else clock_ms   # Long waits use the ms clock
+    maxsecs = MAXSECS if clock is None else clock.maxsecs
+    count, tstart = divmod(secs, maxsecs)
     overshoot = 0
     if tstart > 0:
-        res = yield Timeout(tstart)
+        res = yield Timeout(tstart, clock)
         overshoot = res[2]
     while count:
-        res = yield Timeout(MAXSECS)
+        res = yield Timeout(maxsecs, clock)
         overshoot += res[2]
         count -= 1
     return (0, 0, overshoot)
 
+# IRQ RING BUFFER
+# Passes data from an interrupt handler to a thread. Values are stored in a preallocated array of the given type so
+# put() does not allocate and may be called in an ISR. There is one writer (the ISR) and one reader (a thread): each
+# updates only its own index, so interrupts need not be disabled. If the ring is full the value is discarded and
+# counted in overflow. The thread may wait with yield Poller(ring.poll) or use a Pinblock with a ring.
+
+class IrqRing(object):
+    def __init__(self, size, typecode='I'):
+        if size < 1:
+            raise ValueError('Ring size must be >= 1')
+        self.buf = array(typecode, [0] * (size + 1))   # One slot is always empty
+        self.wi = 0                             # Write index: changed only by put()
+        self.ri = 0                             # Read index: changed only by the reader
+        self.overflow = 0                       # No. of values discarded
+
+    def __len__(self):
+        return (self.wi - self.ri) % len(self.buf)
+
+    def put(self, value):                       # Runs in interrupt's context. Returns False on overflow
+        wi = self.wi + 1
+        if wi == len(self.buf):
+            wi = 0
+        if wi == self.ri:
+            self.overflow += 1
+            return False
+        self.buf[self.wi] = value
+        self.wi = wi
+        return True
+
+    def get(self):                              # Return the oldest value or None if empty
+        ri = self.ri
+        if ri == self.wi:
+            return None
+        value = self.buf[ri]
+        ri += 1
+        self.ri = 0 if ri == len(self.buf) else ri
+        return value
+
+    def getinto(self, dest):                    # Move up to len(dest) values into dest, oldest first. Return the no.
+        buf = self.buf
+        size = len(buf)
+        ri = self.ri
+        wi = self.wi
+        n = 0
+        while n < len(dest) and ri != wi:
+            dest[n] = buf[ri]
+            ri += 1
+            if ri == size:
+                ri = 0
+            n += 1
+        self.ri = ri
+        return n
+
+    def poll(self):                             # For Poller: the no. of values held or None if empty
+        n = len(self)
+        return n if n else None
+
+    def clear(self):
+        self.ri = self.wi
+
 # Block on an interrupt from a pin subject to optional timeout. pyb specific.
+# If ring is an IrqRing each interrupt puts the value returned by capture() into it, by default ticks_us().
 class Pinblock(Waitfor):
     initialised = False
-    def __init__(self, pin, mode, pull, customcallback = None, timeout = None):
+    def __init__(self, pin, mode, pull, customcallback = None, timeout = None, ring = None, capture = None):
         if platform != 'pyboard':
             raise ValueError('Pinblock only valid on Pyboard')
         super().__init__()
@@ -148,6 +336,8 @@ class Pinblock(Waitfor):
             micropython.alloc_emergency_exception_buf(100) 
             Pinblock.initialised = True
         self.customcallback = customcallback
+        self.ring = ring
+        self.capture = capture
         if timeout is None:
             self.forever = True
         else:
@@ -164,20 +354,108 @@ class Poller(Waitfor):
         else:
             self.setdelay(timeout)
 
+# A thread which yields an Event that has not been set is not polled: the scheduler parks it until
+# set() is called, after which it is scheduled like a Poller whose function returned the value passed
+# to set(). All waiting threads are released. The Event stays set until cleared. set() must not be
+# called from an interrupt handler. An Event with a timeout is polled for the timeout in the normal way.
+class Event(Waitfor):
+    def __init__(self, timeout = None):
+        super().__init__()
+        self.value = 0                          # Nonzero when set
+        self.waiters = []                       # Parked threads
+        if timeout is None:
+            self.forever = True
+        else:
+            self.setdelay(timeout)
+
+    def triggered(self):
+        if self.value:
+            return (0, self.value, 0)
+        return super().triggered()              # Check for timeout
+
+    def set(self, value=1):
+        self.value = value
+        for thread in self.waiters:             # Release waiting threads
+            if thread[Sched.STATE] == Sched.WAITING:
+                thread[Sched.STATE] = Sched.RUNNING
+        self.waiters.clear()
+
+    def clear(self):
+        self.value = 0
+
+    def is_set(self):
+        return self.value != 0
+
+    def _park(self, thread):                    # Return True if the thread must wait
+        if self.value or not self.forever:
+            return False
+        self.waiters.append(thread)
+        return True
+
+# TRACE RECORDER
+# Each record is two 32 bit words: ticks_us() and (pid << 8) | (event << 4) | arg. Records are written to a
+# preallocated ring so recording does not allocate and may be done in an interrupt handler. For TR_IRQ records
+# the pid field holds the IRQ no. A dump comprises b'UTR1', the no. of records (4 bytes LS first) and the records
+# oldest first, each word LS byte first. trace2json.py converts a dump to a timeline.
+
+TR_START = const(0)                             # Thread added
+TR_RESUME = const(1)                            # Thread run. arg: 0 roundrobin 1 interrupt 2 poll or event 3 time
+TR_YIELD = const(2)                             # arg: 0 roundrobin 1 delay 2 Poller 3 Pinblock 4 Event
+TR_END = const(3)                               # Thread terminated or stopped
+TR_IRQ = const(4)                               # Pinblock interrupt
+TR_GC = const(5)                                # arg: 0 start 1 end
+
+_trace = None                                   # Active Trace instance: accessible to interrupt handlers
+
+class Trace(object):
+    def __init__(self, size):
+        self.buf = array('I', [0] * (2 * size))
+        self.size = size
+        self.idx = 0                            # Next record
+        self.n = 0                              # No. of valid records
+
+    def record(self, event, pid=0, arg=0):     # A record may be lost if an interrupt records concurrently
+        idx = self.idx
+        buf = self.buf
+        buf[2 * idx] = ticks_us()
+        buf[2 * idx + 1] = (pid << 8) | (event << 4) | arg
+        idx += 1
+        self.idx = 0 if idx == self.size else idx
+        if self.n < self.size:
+            self.n += 1
+
+    def dump(self, stream):                     # Write records oldest first
+        n = self.n
+        stream.write(b'UTR1')
+        stream.write(bytes((n & 0xff, (n >> 8) & 0xff, (n >> 16) & 0xff, n >> 24)))
+        mv = memoryview(self.buf)
+        start = self.idx - n                    # Oldest record
+        if start < 0:                           # Ring has wrapped
+            stream.write(mv[2 * (start + self.size):])
+            start = 0
+        stream.write(mv[2 * start:2 * self.idx])
+
+    def clear(self):
+        self.idx = 0
+        self.n = 0
+
 # SCHEDULER CLASS
 
 class Sched(object):
     GCTIME = const(50000)
     HBTIME = const(200000)
+    SPINTIME = const(100)                       # uS before a spin timeout at which the scheduler busy-waits
     DEAD = const(0)
     RUNNING = const(1)
     PAUSED = const(2)
+    WAITING = const(3)                          # Parked on an Event
     YIELDED = const(0)
     FUNC = const(1)
     PID = const(2)
     STATE = const(3)
     DUE = const(4)
-    def __init__(self, gc_enable=True, heartbeat=None):
+    def __init__(self, gc_enable=True, heartbeat=None, trace=0):
+        global _trace
         self.lstThread = []                     # Entries contain [Waitfor object, function, pid, state, due]
         self.add_thread_bar = False             # Re-entrancy check
         self.bStop = False
@@ -196,6 +474,21 @@ class Sched(object):
             elif platform == 'esp8266':
                 import machine
                 self.heartbeat = machine.Pin(2, machine.Pin.OUT)
+        self.current = 0                        # pid of running thread, 0 if none
+        self.spinning = False                   # A spin Timeout's window has been entered
+        self.trace = None                       # Trace recorder
+        if trace:
+            self.trace = Trace(trace)           # trace is the no. of records
+            _trace = self.trace
+
+    def dump_trace(self, f):                    # f is a filename or a stream opened in binary mode
+        if self.trace is None:
+            raise OSError('Trace is not enabled')
+        if isinstance(f, str):
+            with open(f, 'wb') as stream:
+                self.trace.dump(stream)
+        else:
+            self.trace.dump(f)
 
     def __getitem__(self, pid):                 # Index by pid
         threads = [thread for thread in self.lstThread if thread[PID] == pid]
@@ -214,6 +507,8 @@ class Sched(object):
             thread = self[pid]
             thread[FUNC].close()                # Ensure try...finally and __exit__() work
             thread[STATE] = DEAD
+            if self.trace is not None:
+                self.trace.record(TR_END, pid)
         except ValueError:                      # Missing presumed killed in action
             pass
 
@@ -229,7 +524,7 @@ class Sched(object):
             state = self[pid][STATE]
         except ValueError:
             pass                                # Thread died
-        return state
+        return RUNNING if state == WAITING else state
 
 # Thread list contains [Waitfor object, generator, pid, state, due]: Run thread to first yield to acquire 
 # a Waitfor instance and put the resultant thread onto the threadlist
@@ -240,16 +535,22 @@ class Sched(object):
         if type(func) is not GeneratorType:
             raise ValueError('Threads must be added using function call syntax')
         self.pid += 1
+        if self.trace is not None:
+            self.trace.record(TR_START, self.pid)
         self.lstThread.append([func.send(None), func, self.pid, RUNNING, True])
         self.add_thread_bar = False
         return self.pid
 
 # Runs once then in roundrobin or when there's nothing else to do
     def _idle_thread(self):
-        if self.gc_enable and (self.last_gc == 0 or after(self.last_gc) > GCTIME):
+        if self.gc_enable and not self.spinning and (self.last_gc == 0 or after(self.last_gc) > GCTIME):
+            if self.trace is not None:
+                self.trace.record(TR_GC, 0, 0)
             gc.collect()
             gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
             self.last_gc = ticks_us()
+            if self.trace is not None:
+                self.trace.record(TR_GC, 0, 1)
         if self.heartbeat is not None and (self.last_heartbeat == 0 or after(self.last_heartbeat) > HBTIME):
             if platform == 'pyboard':
                 self.heartbeat.toggle()
@@ -272,14 +573,41 @@ class Sched(object):
         return waitfor.triggered()
 
     def _runthread(self, thread, priority):
+        trace = self.trace
+        if trace is not None:
+            trace.record(TR_RESUME, thread[PID], 1 if priority[0] else 2 if priority[1] else 3 if priority[2] else 0)
+        self.current = thread[PID]              # For sampling profiler
         try:                                    # Run thread, send (interrupt count, poll func value, uS overdue)
-            thread[YIELDED] = thread[FUNC].send(priority)  # Store object yielded by thread
+            wf = thread[FUNC].send(priority)
+            thread[YIELDED] = wf                # Store object yielded by thread
+            if isinstance(wf, Event) and wf._park(thread):
+                thread[STATE] = WAITING         # Not polled until the Event is set
+            if trace is not None:
+                trace.record(TR_YIELD, thread[PID], self._yieldtype(wf))
         except StopIteration:                   # The thread has terminated:
             thread[STATE] = DEAD                # Flag thread for removal
+            if trace is not None:
+                trace.record(TR_END, thread[PID])
+        self.current = 0
+
+    def _yieldtype(self, wf):                   # Trace: classify the object yielded by a thread
+        if wf is None:
+            return 0
+        if isinstance(wf, Event):
+            return 4
+        if isinstance(wf, Waitfor):
+            if wf.irq:
+                return 3
+            if wf.pollfunc:
+                return 2
+            return 0 if wf.roundrobin else 1
+        return 1                                # A number: time delay
 
     def _get_thread(self):
         p_run = None                        # priority tuple of thread to run
         thr_run = None                      # thread to run
+        thr_spin = None                     # spin Timeout thread whose window has been entered
+        us_spin = 0                         # uS until its timeout
         candidates = [t for t in self.lstThread if t[STATE] == RUNNING]
         for thread in candidates:
             priority = self.triggered(thread)
@@ -292,7 +620,19 @@ class Sched(object):
                     if p_run is None or priority > p_run:
                         p_run = priority
                         thr_run = thread
-        return thr_run, p_run
+            else:
+                wf = thread[YIELDED]
+                if isinstance(wf, Waitfor) and wf.spin:
+                    us = microsUntil(wf.timeout)
+                    if us <= wf.spin and (thr_spin is None or us < us_spin):
+                        thr_spin = thread
+                        us_spin = us
+        self.spinning = thr_spin is not None
+        if thr_spin is None or (thr_run is not None and (p_run[0] or p_run[1])):
+            return thr_run, p_run           # Interrupts, polls and events run in a spin window
+        if us_spin > SPINTIME:              # Hold back delays and RR threads
+            return None, None
+        return thr_spin, thr_spin[YIELDED]._spinwait()
 
     def _runthreads(self):
         while not self.bStop:
@@ -302,14 +642,17 @@ class Sched(object):
             self._runthread(thr_run, p_run)
             thr_run[DUE] = False                # Only care if RR
 
-    def run(self):                              # Returns if the stop method is used or all threads terminate
+    def run(self):                              # Returns if the stop method is used or no thread can run
         try:
             while not self.bStop:
                 # Remove dead threads
                 self.lstThread = [thread for thread in self.lstThread if thread[STATE] != DEAD]
                 self._idle_thread()                 # Garbage collect
-                if len(self.lstThread) == 0:
-                    return
+                for thread in self.lstThread:
+                    if thread[STATE] == RUNNING:
+                        break
+                else:                               # All terminated, paused or parked on an Event: only a
+                    return                          # running thread could wake them
                 for thread in self.lstThread:
                     thread[DUE] = True              # Applies only to roundrobin
                 self._runthreads()                  # Returns when all RR threads have run once
@@ -317,4 +660,20 @@ class Sched(object):
         finally:
             for gen in [thread[FUNC] for thread in self.lstThread if thread[STATE] != DEAD]:
                 gen.close()                         # Ensure context managers and finally clauses clean up
-        
\ No newline at end of file
+        
+# NATIVE CODE
+# Where the native code emitter is available the functions run on every pass of the scheduler are replaced by the
+# compiled versions in uschednative.py. On CPython, or if the port lacks the emitter or the module is absent, the
+# bytecode above is used. The bytecode versions are retained in bytecode for comparison by nativebench.py.
+
+bytecode = None
+try:
+    import uschednative
+except (ImportError, SyntaxError):
+    pass
+else:
+    bytecode = (after, microsWhen, Waitfor.triggered, Sched._get_thread)
+    after = uschednative.after
+    microsWhen = uschednative.microsWhen
+    Waitfor.triggered = uschednative.triggered
+    Sched._get_thread = uschednative.get_thread
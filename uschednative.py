@@ -0,0 +1,91 @@
+# uschednative.py Native code versions of the usched functions run on every pass of the scheduler
+# Author: Peter Hinch
+# Copyright Peter Hinch 2016 Released under the MIT license
+
+# Imported by usched.py, which replaces its bytecode functions with these. If the port lacks the native code
+# emitter compiling this module raises SyntaxError and usched uses its own. The code is identical to that in
+# usched.py except that the timer functions use viper integer arithmetic. On ESP8266, where usched must be frozen,
+# this module is frozen as native code (mpy-cross -march=xtensa) or omitted.
+
+import micropython
+from micropython import const
+from utime import ticks_us
+from usched import TimerException, Waitfor, microsUntil
+
+_TIMERPERIOD = const(0x3fffffff)                # As usched.py
+_MAXTIME = const(0x1fffffff)
+_RUNNING = const(1)                             # Sched constants
+_YIELDED = const(0)
+_STATE = const(3)
+_DUE = const(4)
+_SPINTIME = const(100)
+
+@micropython.viper
+def microsWhen(timediff:int) -> int:
+    if timediff >= _MAXTIME:
+        raise TimerException()
+    return (int(ticks_us()) + timediff) & _TIMERPERIOD
+
+@micropython.viper
+def after(trigtime:int) -> int:
+    res = (int(ticks_us()) - trigtime) & _TIMERPERIOD
+    if res >= _MAXTIME:
+        res = 0
+    return res
+
+@micropython.native
+def triggered(self):                            # Waitfor.triggered
+    if self.irq:
+        self.irq.disable()
+        numints = self.interruptcount
+        if numints:
+            self.interruptcount = 0
+        self.irq.enable()
+        if numints:
+            return (numints, 0, 0)
+    if self.pollfunc:
+        res = self.pollfunc(*self.pollfunc_args)
+        if res is not None:
+            return (0, res, 0)
+    if not self.forever:
+        if self.roundrobin:
+            return (0,0,0)
+        if self.clock is None:
+            res = after(self.timeout)
+        else:
+            res = self.clock.late_us(self.timeout)
+        if res:
+            return (0, 0, res)
+    return None
+
+@micropython.native
+def get_thread(self):                           # Sched._get_thread
+    p_run = None
+    thr_run = None
+    thr_spin = None
+    us_spin = 0
+    candidates = [t for t in self.lstThread if t[_STATE] == _RUNNING]
+    for thread in candidates:
+        priority = self.triggered(thread)
+        if priority is not None:
+            if priority == (0,0,0):
+                if thr_run is None and thread[_DUE]:
+                    p_run = priority
+                    thr_run = thread
+            else:
+                if p_run is None or priority > p_run:
+                    p_run = priority
+                    thr_run = thread
+        else:
+            wf = thread[_YIELDED]
+            if isinstance(wf, Waitfor) and wf.spin:
+                us = microsUntil(wf.timeout)
+                if us <= wf.spin and (thr_spin is None or us < us_spin):
+                    thr_spin = thread
+                    us_spin = us
+    self.spinning = thr_spin is not None
+    if thr_spin is None or (thr_run is not None and (p_run[0] or p_run[1])):
+        return thr_run, p_run
+    if us_spin > _SPINTIME:
+        return None, None
+    return thr_spin, thr_spin[_YIELDED]._spinwait()